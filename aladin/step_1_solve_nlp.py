@@ -1,91 +1,148 @@
-from pprint import pprint
+import time
 
 import numpy as np
 import casadi as ca
 
-from problem import SYMBOL_DEBUG, IPOPT_SETTING
-from helper.subsystype import SubSystemType, get_sub_system_type
+from problem import IPOPT_SETTING, IPOPT_WARM_SETTING, get_instance
+from helper import constructor
 from helper.colorize import color_print
-from helper.subsystype import SubSystemType
 
-def step_1_solve_nlp(nlp_struct, sub_index, var_u, var_τ, var_λ, param_ρ):
+def get_nlp_param_val(nlp_struct, var_τ, var_λ, param_ρ):
+    """numerical value of NLP parameter `p`, ordered as [τ, λ, ρ, vehicle data]
+    """
+    var_λ = np.asarray(var_λ, dtype=float).reshape(-1)
+    return np.concatenate((var_τ, var_λ[nlp_struct['λ_index']], [param_ρ], nlp_struct['vehicle_val']))
 
-    goal_func = nlp_struct['cost']
-    goal_func += param_ρ/2 * ca.transpose(nlp_struct['xt']-var_τ)@(nlp_struct['xt']-var_τ)
-    if SYMBOL_DEBUG:
-        goal_func += var_λ[sub_index]*nlp_struct['tc'] \
-            if nlp_struct['type'] in (SubSystemType.head, SubSystemType.body) else 0
-        goal_func -= var_λ[sub_index-1]*nlp_struct['tin'] \
-            if nlp_struct['type'] in (SubSystemType.body, SubSystemType.tail) else 0
-    else:
-        goal_func -= var_λ[sub_index]*nlp_struct['tc'] \
-            if nlp_struct['type'] in (SubSystemType.head, SubSystemType.body) else 0
-        goal_func += var_λ[sub_index-1]*nlp_struct['tin'] \
-            if nlp_struct['type'] in (SubSystemType.body, SubSystemType.tail) else 0
-    
-    nlp = {
-        'x': nlp_struct['x'],
-        'f': goal_func,
-        'g': nlp_struct['g']
-    }
+def get_warm_start(opt_soln, instance=None):
+    """multipliers of the previous solve, `None` if warm start is disabled
+    """
+    if instance is None:
+        instance = get_instance()
+    if not instance.aladin_cfgs['WARM_START'] or opt_soln is None:
+        return None
+    return {'lam_x0': opt_soln['lam_x'], 'lam_g0': opt_soln['λ']}
 
-    color_print('info', 1,
-        'Running IPOPT to optimize subsystem {}'.format(sub_index+1)
-    )
+def step_1_solve_nlp(nlp_struct, sub_index, var_u, var_τ, var_λ, param_ρ, warm_start=None, active_tol=1e-8):
+    """STEP 1 solve decoupled NLP
+    Everything returned is numerical (and picklable), so that it can be
+    run in a worker process. The active set is returned as row indices
+    of the full constraint [gu, u], a control bound is active if the
+    magnitude of its dual exceeds `active_tol`.
 
-    nlp_solver = ca.nlpsol('S', 'ipopt', nlp, IPOPT_SETTING)
+    `warm_start` holds `lam_x0` and `lam_g0` of the previous solve.
+    """
+    param_val = get_nlp_param_val(nlp_struct, var_τ, var_λ, param_ρ)
 
-    color_print('debug', 3, 'Passing x to NLP solver')
-    pprint(nlp_struct['x'], indent=2)
+    color_print('info', 1, 'Running IPOPT to optimize subsystem {}', sub_index+1)
 
-    color_print('debug', 3, 'Passing initializing point to NLP solver')
-    pprint(ca.vertcat(var_τ, var_u))
+    if warm_start is None:
+        nlp_solver = nlp_struct['solver'] if nlp_struct['solver'] is not None \
+            else ca.nlpsol('S', 'ipopt', nlp_struct['nlp_lib'] or nlp_struct['nlp'], IPOPT_SETTING)
+        warm_start = dict()
+    else:
+        nlp_solver = nlp_struct['warm_solver'] if nlp_struct['warm_solver'] is not None \
+            else ca.nlpsol('W', 'ipopt', nlp_struct['nlp_lib'] or nlp_struct['nlp'], IPOPT_WARM_SETTING)
 
+    # states of multiple shooting start from the rollout of u
+    if nlp_struct['state_func'] is None:
+        var_x = ca.vertcat(var_τ, var_u)
+    else:
+        var_x = ca.vertcat(var_τ, var_u, nlp_struct['state_func'](var_τ, var_u, nlp_struct['vehicle_val']))
+
+    color_print('debug', 3, 'Passing x to NLP solver\n{}', nlp_struct['x'])
+    color_print('debug', 3, 'Passing initializing point to NLP solver\n{}', var_x)
+
+    time_start = time.perf_counter()
     opt_sol = nlp_solver(
-        x0=ca.vertcat(var_τ, var_u),
+        x0=var_x,
+        p=param_val,
         lbx=nlp_struct['lbx'],
         ubx=nlp_struct['ubx'],
         lbg=nlp_struct['lbg'],
         ubg=nlp_struct['ubg'],
+        **warm_start
     )
+    ipopt_stats = nlp_solver.stats()
+    ipopt_stats = {
+        'iter_count': ipopt_stats['iter_count'],
+        'return_status': ipopt_stats['return_status'],
+        't_wall': time.perf_counter() - time_start,
+        # time spent in function evaluations
+        't_wall_fun': sum(val for key, val in ipopt_stats.items() if key.startswith('t_wall_nlp_')),
+    }
+
+    n_τ = nlp_struct['xt'].shape[0]
+    n_u = nlp_struct['xu'].shape[0]
 
-    τ_opt = opt_sol['x'].full()[0:3, 0] \
-        if nlp_struct['type'] in (SubSystemType.head, SubSystemType.body) \
-        else opt_sol['x'].full()[0:2, 0]
-    u_opt = opt_sol['x'].full()[3:, 0] \
-        if nlp_struct['type'] in (SubSystemType.head, SubSystemType.body) \
-        else opt_sol['x'].full()[2:, 0]
+    τ_opt = opt_sol['x'].full()[0:n_τ, 0]
+    u_opt = opt_sol['x'].full()[n_τ:n_τ+n_u, 0]
+    s_opt = opt_sol['x'].full()[n_τ+n_u:, 0]
     λ_opt = opt_sol['lam_g'].full()
 
-    # construct active constraint set
-    # Din, Dout are assumed to be always active
-    constraint_h = nlp_struct['gu']
-    # gu are added as the last 2 constraints
-    constraint_dual = opt_sol['lam_g'].full()[-2:]
-
-    # check active constraint
-    control_dual = opt_sol['lam_x'].full()[3:] \
-        if nlp_struct['type'] in (SubSystemType.head, SubSystemType.body) \
-        else opt_sol['lam_x'].full()[2:]
-
-    for control_index, control in enumerate(control_dual):
-        if np.abs(control) > 1e-8:
-            # Assume to be active
-            constraint_h = ca.vertcat(constraint_h, nlp_struct['xu'][control_index])
-    
-    # find all duals corresponding to active constraints
-    control_dual = control_dual[np.abs(control_dual) > 1e-8]
-    constraint_dual = np.append(constraint_dual, control_dual)
-
-    color_print('debug', 3, 'ipopt result for car {}'.format(sub_index+1))
-    color_print('debug', 3, '[{}] Tin, Tout, Tc'.format(sub_index+1))
-    pprint(τ_opt)
-    color_print('debug', 3, '[{}] Control'.format(sub_index+1))
-    pprint(u_opt)
-    color_print('debug', 3, '[{}] λ_opt'.format(sub_index+1))
-    pprint(λ_opt)
+    # construct active constraint set as rows of the full h = [gu, u]
+    # gu are added as the last constraints and are always active
+    n_gu = nlp_struct['gu'].shape[0]
+    constraint_dual = opt_sol['lam_g'].full()[-n_gu:, 0]
+
+    # check active constraint, states are never bounded
+    control_dual = opt_sol['lam_x'].full()[n_τ:n_τ+n_u, 0]
+    active_index = np.flatnonzero(np.abs(control_dual) > active_tol)
+    active_rows = np.concatenate((np.arange(n_gu), n_gu+active_index))
+
+    # duals corresponding to active constraints
+    constraint_dual = np.concatenate((constraint_dual, control_dual[active_index]))
+
+    color_print('debug', 3, 'ipopt result for car {}', sub_index+1)
+    color_print('debug', 3, '[{}] Tin, Tout, Tc\n{!r}', sub_index+1, τ_opt)
+    color_print('debug', 3, '[{}] Control\n{!r}', sub_index+1, u_opt)
+    color_print('debug', 3, '[{}] λ_opt\n{!r}', sub_index+1, λ_opt)
 
     return {'τ': τ_opt, 'opt_movement': param_ρ*np.abs(τ_opt-var_τ),
-            'u': u_opt, 'λ': λ_opt,
-            'active_constraint': constraint_h, 'active_dual_val': constraint_dual
-            }, goal_func
+            'u': u_opt, 's': s_opt, 'λ': λ_opt, 'p': param_val,
+            'lam_x': opt_sol['lam_x'].full(),
+            'ipopt_iter': ipopt_stats['iter_count'], 'ipopt_stats': ipopt_stats,
+            'active_rows': active_rows, 'active_dual_val': constraint_dual
+            }
+
+
+"""
+Parallel STEP 1
+---------------
+Every worker process builds and keeps its own NLP structs (and cached
+solvers) of the vehicles it is asked to solve, keyed by problem instance.
+Only numerical iterates and the variable bounds of every vehicle are sent
+to the workers, so that bounds changed by the caller (like the lead
+vehicle of `receding_horizon`) are used, and only numerical results are
+sent back. A pool outlives the instances solved on it, structs of an
+earlier instance are dropped once a worker gets a task of a new one,
+solvers stay cached in the NLP templates.
+"""
+_worker_nlp_struct = dict()
+
+def _solve_nlp_in_worker(instance, sub_index, lbx, ubx, var_u, var_τ, var_λ, param_ρ, warm_start):
+    struct_key = (instance.key, sub_index)
+    if struct_key not in _worker_nlp_struct:
+        if any(key[0] != instance.key for key in _worker_nlp_struct):
+            _worker_nlp_struct.clear()
+        _worker_nlp_struct[struct_key] = constructor.build_nlp_struct(sub_index, instance=instance)
+    nlp_struct = {**_worker_nlp_struct[struct_key], 'lbx': lbx, 'ubx': ubx}
+    return step_1_solve_nlp(
+        nlp_struct, sub_index, var_u, var_τ, var_λ, param_ρ, warm_start,
+        instance.aladin_cfgs['ACTIVE_TOL']
+    )
+
+def step_1_solve_nlp_pool(pool, nlp_struct, var_u, var_τ, var_λ, param_ρ, warm_start, instance=None):
+    """solve all decoupled NLPs with a `multiprocessing.Pool`
+    """
+    if instance is None:
+        instance = get_instance()
+    return pool.starmap(
+        _solve_nlp_in_worker,
+        [
+            (
+                instance, sub_index, nlp_struct[sub_index]['lbx'], nlp_struct[sub_index]['ubx'],
+                var_u[sub_index], var_τ[sub_index], var_λ, param_ρ, warm_start[sub_index]
+            )
+            for sub_index in range(len(nlp_struct))
+        ]
+    )
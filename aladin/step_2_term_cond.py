@@ -1,78 +1,109 @@
-from pprint import pprint
-
 import numpy as np
 import casadi as ca
 
-from problem import SUB_SYS_COUNT, SYMBOL_DEBUG, ALADIN_CFGS
+from problem import SYMBOL_DEBUG, get_instance
 from helper.colorize import color_print
+from helper.coupling import get_τ_offsets, build_coupling_matrix
 
-def step_2_term_cond(opt_soln_list):
+def step_2_term_cond(opt_soln_list, instance=None):
     """STEP 2 check termination condition
 
     First, form constraint A matrices by checking
     whether constraints of subproblems are active.
 
+    Components of the residual are returned as well,
+    `coupling` for |Σ Aiyi - b| and `movement` for ρ|τi - zi|
+    of the termination condition, and `coupling_max` for the
+    largest violation max|Aiyi - b|, in which violations of
+    opposite sign don't cancel.
+
     """
 
-    qp_mat_a_rows, qp_vec_b = [], []
+    if instance is None:
+        instance = get_instance()
+    sub_sys_count = len(opt_soln_list)
+
+    τ_offsets = get_τ_offsets(sub_sys_count)
+    opt_τ = np.concatenate([opt_soln['τ'] for opt_soln in opt_soln_list])
+
+    t_in__val = opt_τ[τ_offsets[1:-1]]
+    t_out_val = opt_τ[τ_offsets[:-2]+1]
+    t_c___val = opt_τ[τ_offsets[:-2]+2]
 
     """
     TiC + ΔTiC = Ti+1In + ΔTi+1In
     Coordinate TiC of previous car and Tin of the following car.
+    NOTE symbol problem
     """
-    for sub_index in range(SUB_SYS_COUNT-1):
-        t_c__i = opt_soln_list[sub_index]['τ'][-1]
-        t_in_n = opt_soln_list[sub_index+1]['τ'][0]
-        qp_mat_a_row = [0]*3*sub_index + [0, 0, 1]
-        if sub_index+1 == SUB_SYS_COUNT-1:
-            # Reaching last car
-            qp_mat_a_row += [-1, 0]
-        else:
-            qp_mat_a_row += [-1, 0, 0] + [0]*3*(SUB_SYS_COUNT-sub_index-3) + [0]*2
-        qp_mat_a_rows.append(qp_mat_a_row)
-        # NOTE symbol problem
-        qp_vec_b += [t_in_n-t_c__i]
+    qp_vec_b = t_in__val - t_c___val
 
     """
     Tout + ΔTout = Tc + ΔTc
     Ensure copied variable is consistent with the original variable.
     NOTE Tc-Tout or Tout-Tc, λ
     """
-    for sub_index in range(SUB_SYS_COUNT-1):
-        t_out_val = opt_soln_list[sub_index]['τ'][1]
-        t_c___val = opt_soln_list[sub_index]['τ'][2]
-        if SYMBOL_DEBUG:
-            c_diff = t_c___val - t_out_val
-        else:
-            c_diff = t_out_val - t_c___val
-        if c_diff <= ALADIN_CFGS['COPIED_GAP']:
-            # Tc appears to be smaller than Tout,
-            # constraint is active
-            qp_mat_a_row = [0]*3*sub_index
-            qp_mat_a_row += [0, 1, -1]
-            #              NOTE ~  ^^
-            qp_mat_a_row += [0]*3*(SUB_SYS_COUNT-sub_index-2)
-            qp_mat_a_row += [0]*2
-            qp_mat_a_rows.append(qp_mat_a_row)
-            qp_vec_b += [0]
-
-    qp_mat_a = np.array([np.array(row) for row in qp_mat_a_rows])
+    if SYMBOL_DEBUG:
+        c_diff = t_c___val - t_out_val
+    else:
+        c_diff = t_out_val - t_c___val
+    # Tc appears to be smaller than Tout,
+    # constraint is active
+    copy_active = c_diff <= instance.aladin_cfgs['COPIED_GAP']
+    qp_vec_b = np.concatenate((qp_vec_b, np.zeros(np.count_nonzero(copy_active))))
+
+    qp_mat_a = build_coupling_matrix(τ_offsets, copy_active)
     """
     $$ | \sum_{i=1}^N A_i y_i - b | \le \epsilon $$
     """
-    ai_times_yi_minus_b = qp_mat_a@np.hstack((opt_soln_list[0]['τ'], opt_soln_list[1]['τ'], opt_soln_list[2]['τ'], opt_soln_list[3]['τ']))
-    ai_times_yi_minus_b -= np.array(qp_vec_b)
+    ai_times_yi_minus_b = qp_mat_a@opt_τ
+    ai_times_yi_minus_b -= qp_vec_b
     sum_ai_times_yi_minus_b = np.abs(np.sum(ai_times_yi_minus_b))
+    max_ai_times_yi_minus_b = np.abs(ai_times_yi_minus_b).max(initial=0.)
 
     """
     ρ|τi - zi| \le epsion
     """
     max_opt_movement = 0
-    for sub_index in range(SUB_SYS_COUNT):
+    for sub_index in range(sub_sys_count):
         max_opt_movement = max(max_opt_movement, max(opt_soln_list[sub_index]['opt_movement']))
-    
-    color_print('info', 2, 'residual')
-    pprint(max(sum_ai_times_yi_minus_b, max_opt_movement))
 
+    residual = {
+        'coupling': sum_ai_times_yi_minus_b,
+        'movement': max_opt_movement,
+        'coupling_max': max_ai_times_yi_minus_b,
+    }
+
+    color_print('info', 2, 'residual {residual:.6e}', residual=get_residual(residual))
+
+    return get_residual(residual) <= instance.aladin_cfgs['TOL'], qp_mat_a, qp_vec_b, residual
+
+def get_residual(residual) -> float:
+    """residual of the termination condition
+    """
+    return max(residual['coupling'], residual['movement'])
+
+def update_ρ(param_ρ, residual, adaptive_ρ_cfgs, prev_residual=None):
+    """ρ of the next iteration, balancing the residuals of STEP 2
+
+    A large coupling violation `coupling_max` calls for a stronger
+    penalty of τ moving away from z, a large `movement` for a weaker
+    one. ρ is raised as well if the coupling violation is the larger
+    one and above `stall` times the one of the previous iteration
+    `prev_residual`, since iterates stall if ρ is too small.
+    ρ is a parameter of the NLP, changing it needs no rebuild.
+
+    """
+    if not adaptive_ρ_cfgs['ENABLED']:
+        return param_ρ
+
+    ρ_next = param_ρ
+    is_stalled = prev_residual is not None and residual['coupling_max'] > residual['movement'] \
+        and residual['coupling_max'] > adaptive_ρ_cfgs['STALL']*prev_residual['coupling_max']
+    if residual['coupling_max'] > adaptive_ρ_cfgs['RATIO']*residual['movement'] or is_stalled:
+        ρ_next = param_ρ*adaptive_ρ_cfgs['INCREASE']
+    elif residual['movement'] > adaptive_ρ_cfgs['RATIO']*residual['coupling_max']:
+        ρ_next = param_ρ/adaptive_ρ_cfgs['DECREASE']
+    ρ_next = min(max(ρ_next, adaptive_ρ_cfgs['MIN']), adaptive_ρ_cfgs['MAX'])
 
-    return max(sum_ai_times_yi_minus_b, max_opt_movement) <= ALADIN_CFGS['TOL'], qp_mat_a, qp_vec_b
+    color_print('debug', 2, 'ρ {:.6e} -> {:.6e}', param_ρ, ρ_next)
+    return ρ_next
@@ -1,69 +1,69 @@
 import numpy as np
-import casadi as ca
 
-def step_3_derivatives(nlp_struct, nlp_goal_func, opt_soln):
-    f = nlp_goal_func
-    h = opt_soln['active_constraint']
-    x = nlp_struct['xt']
-    y = nlp_struct['xu']
-    x_val = opt_soln['τ']
-    y_val = opt_soln['u']
-    dual_val = opt_soln['active_dual_val']
+from helper.exact_derivative import exact_hessian, exact_hessian_batch
+from helper.quasi_newton import eval_gradients
 
-    # this function compute the gradient and hessian of g(x) defined as
-    # g(x) = min_y f(x,y) s.t. h(x,y) = 0 | kappa
-    # here, y^*(x) and kappa^*(x) can be consdiered as functions of x
+def step_3_derivatives(nlp_struct, opt_soln):
+    """STEP 3 find gradient and Hessian of the subproblem
 
-    # % define Lagrangian
-    L = f + ca.mtimes(ca.transpose(dual_val), h)
-    
-    # % compute partial first order derivative
-    fx = ca.gradient(f, x)
-    eval_fx = ca.Function('fx', [x, y], [fx])
-    val_fx = eval_fx(x_val, y_val).full()
+    Derivative functions are built once per subsystem type, over all
+    constraints, only numerical values are passed on every iteration
+    and rows of the active set are selected from the results.
+    y are the controls, followed by states in multiple shooting.
 
-    fy = ca.gradient(f, y)
-    eval_fy = ca.Function('fx', [x, y], [fy])
-    val_fy = eval_fy(x_val,y_val).full()
+    """
+    H, g = exact_hessian(
+        nlp_struct,
+        opt_soln['active_rows'],
+        opt_soln['τ'], np.concatenate((opt_soln['u'], opt_soln['s'])), opt_soln['p'],
+        opt_soln['active_dual_val']
+    )
 
-    # % compute partial second order derivative
-    Lxx = ca.hessian(L, x)[0]
-    eval_Lxx = ca.Function('Lxx', [x, y], [Lxx])
-    val_Lxx = eval_Lxx(x_val,y_val)
-
-    Lyy = ca.hessian(L, y)[0]
-    eval_Lyy = ca.Function('Lyy', [x, y], [Lyy])
-    val_Lyy = eval_Lyy(x_val,y_val)
-
-    Lx = ca.gradient(L, x)
-    Ly = ca.gradient(L, y)
+    return g, H
 
-    Lyx = ca.jacobian(Ly, x)
-    eval_Lyx = ca.Function('Lyx', [x, y], [Lyx])
-    val_Lyx = eval_Lyx(x_val,y_val).full()
+def step_3_derivatives_batch(nlp_struct_list, opt_soln_list, parallelization='serial', thread_count=1):
+    """STEP 3 of all vehicles
 
-    Lxy = ca.jacobian(Lx, y)
-    eval_Lxy = ca.Function('Lxy', [x, y], [Lxy])
-    val_Lxy = eval_Lxy(x_val,y_val).full()
+    Derivatives of vehicles of the same subsystem type are evaluated
+    in one mapped call, with `parallelization` `serial` or `thread`.
+    Returns gradients and Hessians of all vehicles.
 
-    hx = ca.jacobian(h, x)
-    eval_hx = ca.Function('hx', [x, y], [hx])
-    val_hx = eval_hx(x_val,y_val).full()
+    """
+    hessian_list = exact_hessian_batch(
+        nlp_struct_list,
+        [opt_soln['active_rows'] for opt_soln in opt_soln_list],
+        [opt_soln['τ'] for opt_soln in opt_soln_list],
+        [np.concatenate((opt_soln['u'], opt_soln['s'])) for opt_soln in opt_soln_list],
+        [opt_soln['p'] for opt_soln in opt_soln_list],
+        [opt_soln['active_dual_val'] for opt_soln in opt_soln_list],
+        parallelization, thread_count
+    )
 
-    hy = ca.jacobian(h, y)
-    eval_hy = ca.Function('hy', [x, y], [hy])
-    val_hy = eval_hy(x_val,y_val).full()
+    return [g for H, g in hessian_list], [H for H, g in hessian_list]
 
-    # % comput dy/dx, dkppa/dx
-    val_Lyy_inv = np.linalg.pinv(val_Lyy.full())
-    dkdx = np.dot(np.linalg.pinv(val_hy @ val_Lyy_inv @ ca.transpose(val_hy)),(val_hx - val_hy @ val_Lyy_inv @ val_Lyx))
-    dydx = -val_Lyy_inv @ (ca.transpose(val_hy) @ dkdx + val_Lyx)
+def step_3_derivatives_bfgs(nlp_struct_list, opt_soln_list, block_bfgs, param_ρ):
+    """STEP 3 of all vehicles with approximated Hessians
 
-    # % gradient 
-    g = val_fx + ca.transpose(dydx) @ val_fy
-    # % Hessian
-    H = val_Lxx.full() + val_Lxy @ dydx.full() - dydx.T @ val_hy.T @ dkdx 
+    Gradients are exact, Hessians are damped BFGS updates of
+    `block_bfgs` plus ρI. The exact STEP 3 is used for vehicles
+    whose update fails, and their BFGS update restarts from it.
 
-    g, H = H.full(), g.full()
+    """
+    qp_gradient, qp_hessian = [], []
+    for sub_index, (nlp_struct, opt_soln) in enumerate(zip(nlp_struct_list, opt_soln_list)):
+        g, cost_g = eval_gradients(
+            nlp_struct,
+            opt_soln['active_rows'],
+            opt_soln['τ'], np.concatenate((opt_soln['u'], opt_soln['s'])), opt_soln['p'],
+            opt_soln['active_dual_val']
+        )
+        B = block_bfgs.update(sub_index, opt_soln['τ'], cost_g)
+        if B is None:
+            g, H = step_3_derivatives(nlp_struct, opt_soln)
+            block_bfgs.reset(sub_index, H - param_ρ*np.eye(len(H)))
+        else:
+            H = B + param_ρ*np.eye(len(B))
+        qp_gradient.append(g)
+        qp_hessian.append(H)
 
-    return g, H
+    return qp_gradient, qp_hessian
@@ -1,23 +1,159 @@
+import time
+
 import numpy as np
-from scipy.linalg import block_diag
 import casadi as ca
+import scipy.sparse as sp
+from scipy.sparse.linalg import splu
 
 from problem import QPOASES_SETTING
 from helper.colorize import color_print
 
-def step_4_solve_qp(qp_h_list, qp_g_list, qp_a, qp_b):
-    qp_h = block_diag(qp_h_list[0], qp_h_list[1], qp_h_list[2], qp_h_list[3])
+class ConsensusQP:
+    """`class` ConsensusQP
+    ----------------------
+    Keeps qpOASES solvers of the consensus QP alive between
+    ALADIN iterations, keyed by sparsity of (H, A). Rows of A
+    only change when a Tout/Tc copy constraint switches, so
+    the same solver is hot-started from its previous primal
+    and dual solution most of the time.
+    """
+    def __init__(self):
+        self.qp_solvers = dict()
+        self.prev_soln = dict()
+        self.kkt_orders = dict()
+        self.hit_count = 0
+        self.miss_count = 0
+        self.kkt_count = 0
+        self.fallback_count = 0
+        self.last_stats = None
+
+    def solve_kkt(self, qp_h_list, qp_g, qp_a, qp_b):
+        """`method` solve_kkt
+        ----------------------
+        Equality constrained QP solved as its KKT system
+
+            [H  Aᵀ] [ Δτ]   [-g]
+            [A  0 ] [  λ] = [ b]
+
+        with a sparse LU. Rows and columns are ordered vehicle
+        by vehicle, which makes the system banded, so that the
+        factorization costs time linear in the vehicle count.
+        Returns `None` if the KKT matrix is singular.
+        """
+        time_start = time.perf_counter()
+        τ_sizes = [len(qp_h_i) for qp_h_i in qp_h_list]
+        order_key = (tuple(τ_sizes), tuple(qp_a.indices), tuple(qp_a.indptr))
+        if order_key not in self.kkt_orders:
+            self.kkt_orders[order_key] = get_kkt_order(τ_sizes, qp_a)
+        kkt_order = self.kkt_orders[order_key]
+
+        kkt_mat = sp.bmat([[sp.block_diag(qp_h_list), qp_a.T], [qp_a, None]], format='csc')
+        kkt_rhs = np.concatenate((-np.ravel(qp_g), qp_b))
+        try:
+            kkt_lu = splu(kkt_mat[kkt_order][:, kkt_order], permc_spec='NATURAL')
+        except RuntimeError:
+            return None
+        kkt_soln = np.empty_like(kkt_rhs)
+        kkt_soln[kkt_order] = kkt_lu.solve(kkt_rhs[kkt_order])
+        if not np.all(np.isfinite(kkt_soln)):
+            return None
+
+        self.kkt_count += 1
+        # same keys as qpOASES statistics, no working set
+        self.last_stats = {
+            'iter_count': 0, 'return_status': 'KKT', 't_wall_solver': time.perf_counter()-time_start
+        }
+        var_count = qp_a.shape[1]
+        return kkt_soln[:var_count,None], kkt_soln[var_count:,None]
+
+    def solve(self, qp_h, qp_g, qp_a, qp_b):
+        qp_key = (tuple(qp_h.sparsity().compress()), tuple(qp_a.sparsity().compress()))
+
+        if qp_key in self.qp_solvers:
+            self.hit_count += 1
+            qp_solver = self.qp_solvers[qp_key]
+            prev_soln = self.prev_soln[qp_key]
+            warm_start = {
+                'x0': prev_soln['x'],
+                'lam_x0': prev_soln['lam_x'],
+                'lam_a0': prev_soln['lam_a'],
+            }
+        else:
+            self.miss_count += 1
+            qp = {
+                'h': qp_h.sparsity(),
+                'a': qp_a.sparsity(),
+            }
+            qp_solver = ca.conic('S', 'qpoases', qp, QPOASES_SETTING)
+            self.qp_solvers[qp_key] = qp_solver
+            warm_start = dict()
+
+        # NOTE lba and uba as b
+        opt_qp_soln = qp_solver(h=qp_h, g=qp_g, a=qp_a, lba=qp_b, uba=qp_b, **warm_start)
+        self.prev_soln[qp_key] = opt_qp_soln
+        self.last_stats = qp_solver.stats()
+
+        return opt_qp_soln
+
+    def stats(self) -> dict:
+        """how often a cached solver is reused
+        """
+        solve_count = self.hit_count + self.miss_count
+        return {
+            'solve_count': solve_count,
+            'hit_count': self.hit_count,
+            'miss_count': self.miss_count,
+            'reuse_rate': self.hit_count / solve_count if solve_count else 0.,
+            'kkt_count': self.kkt_count,
+            'fallback_count': self.fallback_count,
+        }
+
+def get_kkt_order(τ_sizes, qp_a) -> np.ndarray:
+    """`function` get_kkt_order
+    ---------------------------
+    Permutation of the KKT system, τ of every vehicle followed by
+    the rows of A starting at it, i.e. TiC - Ti+1In and TiOut - TiC
+    follow τ of vehicle i. Every block couples to the next only.
+    """
+    τ_offsets = np.concatenate(([0], np.cumsum(τ_sizes)))
+    qp_a = sp.csr_matrix(qp_a)
+    row_first_col = np.array([
+        qp_a.indices[qp_a.indptr[row]:qp_a.indptr[row+1]].min() for row in range(qp_a.shape[0])
+    ], dtype=int)
+    block_index = np.concatenate((
+        np.repeat(np.arange(len(τ_sizes)), τ_sizes),
+        np.searchsorted(τ_offsets, row_first_col, side='right') - 1
+    ))
+    is_row = np.concatenate((np.zeros(τ_offsets[-1]), np.ones(qp_a.shape[0])))
+    return np.lexsort((is_row, block_index))
+
+def step_4_solve_qp(qp_h_list, qp_g_list, qp_a, qp_b, consensus_qp=None, qp_solver='kkt'):
+    """STEP 4 solve the consensus QP
+
+    `qp_solver` is `kkt` for a direct solve of the equality
+    constrained QP, qpOASES is used if the KKT matrix is
+    singular, or always if `qp_solver` is `qpoases`.
+
+    """
     qp_g = np.concatenate(qp_g_list, axis=0)
 
-    qp = {
-        'h': ca.DM(qp_h).sparsity(),
-        'a': ca.DM(qp_a).sparsity(),
-    }
+    if consensus_qp is None:
+        consensus_qp = ConsensusQP()
+
+    if qp_solver == 'kkt':
+        kkt_soln = consensus_qp.solve_kkt(
+            [np.asarray(qp_h_i, dtype=float) for qp_h_i in qp_h_list], qp_g, sp.csr_matrix(qp_a), qp_b
+        )
+        if kkt_soln is not None:
+            return kkt_soln
+        consensus_qp.fallback_count += 1
+        color_print('warning', 1, 'KKT matrix of the consensus QP is singular, solving with qpOASES')
 
-    qp_solver = ca.conic('S', 'qpoases', qp, QPOASES_SETTING)
+    # structural sparsity of H does not depend on its values
+    qp_h = ca.diagcat(*[ca.DM(qp_h_i) for qp_h_i in qp_h_list])
+    qp_a = ca.DM(qp_a)
 
-    # NOTE lba and uba as b
-    opt_qp_soln = qp_solver(h=qp_h, g=qp_g, a=qp_a, lba=qp_b, uba=qp_b)
+    opt_qp_soln = consensus_qp.solve(qp_h, qp_g, qp_a, qp_b)
 
     opt_Δτ = opt_qp_soln['x'].full()
     opt_qp_λ = opt_qp_soln['lam_a'].full()
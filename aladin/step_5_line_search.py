@@ -0,0 +1,105 @@
+import numpy as np
+
+from problem import get_instance
+from helper.colorize import color_print
+from helper.coupling import get_coupling_violation
+from helper.exact_derivative import eval_active_derivatives, solve_sensitivity
+
+def get_local_controls(nlp_struct, opt_soln, τ):
+    """controls (and states) minimizing the cost of a subsystem for fixed τ
+    With τ fixed, the dynamics are linear in u, so a single Newton step
+    on the local KKT system from the solution of STEP 1 is exact as long
+    as the active set does not change.
+    """
+    y = np.concatenate((opt_soln['u'], opt_soln['s']))
+
+    _, val_fy, _, val_Lyy, _, _, _, val_hy = eval_active_derivatives(
+        nlp_struct, opt_soln['active_rows'], τ, y, opt_soln['p'], opt_soln['active_dual_val']
+    )
+
+    # residuals of gu, active control bounds stay where they are
+    n_gu = nlp_struct['gu'].shape[0]
+    _, g = nlp_struct['cost_func'](np.concatenate((τ, y)), nlp_struct['vehicle_val'])
+    val_h = np.zeros((val_hy.shape[0], 1))
+    val_h[:n_gu, 0] = g.full()[-n_gu:, 0]
+
+    Δy, _ = solve_sensitivity(val_Lyy, val_fy, val_h, val_hy)
+
+    n_τ, n_u = len(τ), len(opt_soln['u'])
+    y += Δy[:, 0]
+    y[:n_u] = np.clip(y[:n_u], nlp_struct['lbx'][n_τ:n_τ+n_u], nlp_struct['ubx'][n_τ:n_τ+n_u])
+    return y
+
+def get_merit(nlp_struct, τ_offsets, τ_list, y_list, merit_penalty):
+    """L1 merit function
+    sum of costs of all subsystems plus penalized violation
+    of coupling and local constraints
+    """
+    merit, violation = 0., get_coupling_violation(τ_offsets, np.concatenate(τ_list))
+    for sub_index in range(len(nlp_struct)):
+        cost, g = nlp_struct[sub_index]['cost_func'](
+            np.concatenate((τ_list[sub_index], y_list[sub_index])), nlp_struct[sub_index]['vehicle_val']
+        )
+        g = g.full()[:, 0]
+        merit += float(cost)
+        violation += np.sum(np.maximum(0, np.array(nlp_struct[sub_index]['lbg'])-g))
+        violation += np.sum(np.maximum(0, g-np.array(nlp_struct[sub_index]['ubg'])))
+    return merit + merit_penalty*violation
+
+# step of the forward difference of the merit along Δτ
+DERIVATIVE_STEP = 1e-6
+
+def step_5_line_search(nlp_struct, τ_offsets, opt_soln_list, opt_Δτ, instance=None):
+    """STEP 5 globalization
+
+    Return step size α, τ is updated to τ_opt + αΔτ.
+
+    `full` always takes α = 1, `backtracking` shrinks α until the
+    L1 merit function satisfies the Armijo condition
+    φ(α) <= φ(0) + `LS_ARMIJO` α D, with φ(0) at the solutions of
+    STEP 1 and D its directional derivative along Δτ (a forward
+    difference, the L1 merit is only directionally differentiable).
+    If Δτ is no descent direction, any decrease of φ is accepted.
+    If no α is accepted within `LS_MAX_ITER` trials, the evaluated α
+    of the smallest merit is returned.
+    Controls of a trial τ are recovered from the cached cost and
+    derivative functions of every subsystem.
+
+    """
+    aladin_cfgs = (get_instance() if instance is None else instance).aladin_cfgs
+    if aladin_cfgs['LINE_SEARCH'] == 'full':
+        return 1.
+
+    opt_τ = [opt_soln['τ'] for opt_soln in opt_soln_list]
+    Δτ = [opt_Δτ[τ_offsets[sub_index]:τ_offsets[sub_index+1], 0] for sub_index in range(len(nlp_struct))]
+
+    def get_trial_merit(step_α):
+        trial_τ = [τ + step_α*Δτ_i for τ, Δτ_i in zip(opt_τ, Δτ)]
+        trial_y = [
+            get_local_controls(nlp_struct[sub_index], opt_soln_list[sub_index], trial_τ[sub_index])
+            for sub_index in range(len(nlp_struct))
+        ]
+        return get_merit(nlp_struct, τ_offsets, trial_τ, trial_y, aladin_cfgs['MERIT_PENALTY'])
+
+    merit = get_merit(nlp_struct, τ_offsets, opt_τ, [
+        np.concatenate((opt_soln['u'], opt_soln['s'])) for opt_soln in opt_soln_list
+    ], aladin_cfgs['MERIT_PENALTY'])
+    # both ends of the difference with recovered controls
+    merit_slope = min(0., (get_trial_merit(DERIVATIVE_STEP)-get_trial_merit(0.)) / DERIVATIVE_STEP)
+    color_print('debug', 2, 'line search merit {} slope {}', merit, merit_slope)
+
+    step_α, best_α, best_merit = 1., 1., np.inf
+    for _ in range(aladin_cfgs['LS_MAX_ITER']):
+        trial_merit = get_trial_merit(step_α)
+        if trial_merit < best_merit:
+            best_α, best_merit = step_α, trial_merit
+        if trial_merit <= merit + aladin_cfgs['LS_ARMIJO']*step_α*merit_slope and trial_merit < merit:
+            break
+        step_α *= aladin_cfgs['LS_FACTOR']
+    else:
+        step_α = best_α
+        color_print('warning', 1, 'line search did not satisfy the Armijo condition, α = {}', step_α)
+
+    color_print('info', 2, 'line search α = {alpha}', alpha=step_α)
+
+    return step_α
@@ -0,0 +1,11 @@
+"""
+============
+Batch Module
+============
+
+Many intersection scenarios, read from a directory or a
+JSON lines file, solved by a pool of worker processes.
+
+    python -m batch.run scenarios.jsonl --output results.jsonl
+
+"""
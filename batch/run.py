@@ -0,0 +1,195 @@
+"""
+============
+Batch Runner
+============
+
+Scenarios are distributed over a pool of worker processes and
+results are written as JSON lines, in order of completion.
+
+Every worker keeps the NLP templates (with their compiled solvers
+and derivative functions, one per subsystem type) and the consensus
+QP solvers it has built. Scenarios are sorted by N1 / N2 and vehicle
+count and sent in contiguous chunks, so that a worker sees scenarios
+of the same shape one after the other.
+
+    python -m batch.run scenarios.jsonl --output results.jsonl
+    python -m batch.run scenarios/ --output results.jsonl --processes 8
+
+STEP 1 is solved sequentially inside a worker, and instrumentation
+is turned off, see `BATCH_CONFIG`.
+
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import intersection
+from problem import ProblemInstance, get_instance
+from helper import constructor
+from helper.colorize import set_print_level
+from helper.centralized_reference import get_initial_guess
+from aladin.step_4_solve_qp import ConsensusQP
+from batch.scenarios import load_scenarios, merge_configs, estimate_t_guess
+
+# workers are daemonic and may not start STEP 1 pools,
+# and must not export to the same instrument file
+BATCH_CONFIG = {
+    'performance': {'parallel': False},
+    'debug': {'instrument': {'enabled': False}},
+}
+
+def get_group_key(configs: dict, count: int) -> tuple:
+    """`function` get_group_key
+    ---------------------------
+    Scenarios of equal key share NLP templates and QP sparsity.
+    """
+    return (
+        configs['sampling']['N1'], configs['sampling']['N2'], count,
+        configs['problem']['formulation']['shooting'],
+        configs['problem']['formulation']['condensed'],
+        configs['performance']['solver_cache'],
+        configs['aladin']['config']['warm_start'],
+        configs['performance']['codegen']['enabled'],
+    )
+
+class BatchWorker:
+    """`class` BatchWorker
+    ----------------------
+    State of one worker process. NLP templates are kept by
+    `helper.constructor` for the lifetime of the process.
+    """
+    def __init__(self, base_dir, configs, with_controls=False):
+        self.base_dir = base_dir
+        self.configs = configs
+        self.with_controls = with_controls
+        self.consensus_qp = ConsensusQP()
+
+    def solve(self, scenario: dict) -> dict:
+        configs = merge_configs(merge_configs(self.configs, scenario['config']), BATCH_CONFIG)
+        instance = ProblemInstance(
+            self.base_dir, configs=configs, cars=scenario['cars'],
+            t_guess=scenario['t_guess'] or estimate_t_guess(scenario['cars'])
+        ).validate()
+
+        template_count = constructor.get_template_count()
+        nlp_struct = [
+            constructor.build_nlp_struct(v_index, instance=instance) for v_index in range(instance.sub_sys_count)
+        ]
+        var_τ, var_u, var_λ = get_initial_guess(instance)
+        summary = intersection.solve(instance, nlp_struct, var_τ, var_u, var_λ, self.consensus_qp)
+
+        result = {
+            'converged': summary['converged'],
+            'iter_count': summary['iter_count'],
+            'residual': summary['residual'],
+            'ipopt_iter': summary['ipopt_iter'],
+            't_solve': summary['time'],
+            'templates_built': constructor.get_template_count() - template_count,
+            'τ': summary['τ'],
+            'λ': summary['λ'],
+            'ρ': summary['ρ'],
+        }
+        if self.with_controls:
+            result['u'] = summary['u']
+        return result
+
+_worker = None
+
+def _init_worker(base_dir, configs, with_controls, print_level):
+    global _worker
+    _worker = BatchWorker(base_dir, configs, with_controls)
+    set_print_level(print_level)
+
+def _solve_in_worker(scenario: dict) -> dict:
+    time_start = time.perf_counter()
+    result = {'id': scenario['id'], 'count': len(scenario['cars']), 'pid': os.getpid()}
+    try:
+        result.update(_worker.solve(scenario))
+    # one broken scenario must not end the batch
+    except Exception as err:
+        result['error'] = '{}: {}'.format(type(err).__name__, err)
+    result['t_total'] = time.perf_counter() - time_start
+    return result
+
+def run_batch(scenarios, output_path, processes=None, base_dir=None,
+              with_controls=False, print_level=-1, progress=None) -> dict:
+    """`function` run_batch
+    -----------------------
+    Solve `scenarios` (see `batch.scenarios`) with `processes`
+    workers, `pool_cnt` of the base instance by default. Results
+    are appended to `output_path` as soon as they arrive, and
+    passed to `progress` if given. Returns batch statistics.
+    """
+    base_instance = get_instance(base_dir)
+    configs = base_instance.configs
+    processes = processes or base_instance.pool_cnt
+
+    scenarios = sorted(scenarios, key=lambda scenario: str(get_group_key(
+        merge_configs(configs, scenario['config']), len(scenario['cars'])
+    )))
+    # contiguous chunks keep scenarios of one group on one worker
+    chunksize = max(1, len(scenarios) // (4*processes))
+
+    stats = {'scenarios': 0, 'converged': 0, 'failed': 0, 'templates_built': 0}
+    time_start = time.perf_counter()
+    with mp.Pool(
+        processes, initializer=_init_worker,
+        initargs=(base_instance.base_dir, configs, with_controls, print_level)
+    ) as pool, open(output_path, 'w', encoding='utf-8') as jsonl_file:
+        for result in pool.imap_unordered(_solve_in_worker, scenarios, chunksize):
+            jsonl_file.write(json.dumps(result, ensure_ascii=False) + '\n')
+            jsonl_file.flush()
+
+            stats['scenarios'] += 1
+            if 'error' in result:
+                stats['failed'] += 1
+            else:
+                stats['converged'] += result['converged']
+                stats['templates_built'] += result['templates_built']
+            if progress is not None:
+                progress(result, stats, time.perf_counter()-time_start)
+
+    stats['processes'] = processes
+    stats['time'] = time.perf_counter() - time_start
+    stats['throughput'] = stats['scenarios'] / stats['time'] if stats['time'] else 0.
+    return stats
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='ALADIN intersection batch solver')
+    parser.add_argument('scenarios', help='JSON lines file or directory of scenarios')
+    parser.add_argument('--output', default='results.jsonl', help='results as JSON lines')
+    parser.add_argument('--processes', type=int, help='worker processes, pool_cnt by default')
+    parser.add_argument('--base-dir', help='directory of config.json, CWD by default')
+    parser.add_argument('--with-controls', action='store_true', help='include u in results')
+    parser.add_argument('--print-level', type=int, default=-1,
+                        help='print level of workers, nothing is printed below 0')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = load_scenarios(args.scenarios)
+    report_every = max(1, len(scenarios) // 20)
+
+    def progress(result, stats, time_elapsed):
+        if 'error' in result:
+            print('scenario {} failed: {}'.format(result['id'], result['error']))
+        if stats['scenarios'] % report_every == 0 or stats['scenarios'] == len(scenarios):
+            print('{:>6}/{} scenarios, {:.2f} scenarios/s'.format(
+                stats['scenarios'], len(scenarios), stats['scenarios']/time_elapsed
+            ))
+
+    stats = run_batch(
+        scenarios, args.output, args.processes, args.base_dir,
+        args.with_controls, args.print_level, progress
+    )
+    print('{scenarios} scenarios ({converged} converged, {failed} failed) in {time:.2f} s '
+          'with {processes} processes, {throughput:.2f} scenarios/s'.format(**stats))
+    print('NLP templates built {templates_built}'.format(**stats))
+    return 1 if stats['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""
+===============
+Batch Scenarios
+===============
+
+A scenario is one intersection problem, given as
+
+    {"id": "a", "cars": [...], "t_guess": [...], "config": {...}}
+
+`cars` are rows in the schema of `data/cars.csv` (km/h), in
+crossing order. `t_guess` is optional and estimated at constant
+velocity when missing. `config` is optional and merged into the
+`config.json` of the batch, e.g. `{"sampling": {"N1": 8, "N2": 3}}`.
+
+Scenarios are read from a JSON lines file, one per line, or from
+a directory holding `*.json` files of one scenario each and / or
+sub-directories laid out like the repository, i.e. `data/cars.csv`,
+optionally `data/t_guess.csv` and a partial `config.json`.
+
+"""
+
+import json
+import os
+
+from helper.io import json2dict, csv2list
+
+def estimate_t_guess(cars: list) -> list:
+    """`function` estimate_t_guess
+    ------------------------------
+    Constant velocity, every vehicle enters
+    after the previous one has left.
+    """
+    t_guess, t_out_prev = [], 0.
+    for car in cars:
+        velocity = car['V0'] / 3.6
+        t_in = max((car['Din']-car['P0'])/velocity, t_out_prev+.01)
+        t_out = t_in + (car['Dout']-car['Din'])/velocity
+        t_guess.append({'carid': car.get('carid'), 'TinG': t_in, 'ToutG': t_out})
+        t_out_prev = t_out
+    return t_guess
+
+def merge_configs(configs: dict, override: dict) -> dict:
+    """`function` merge_configs
+    ---------------------------
+    `configs` with entries of `override` replaced,
+    nested dicts are merged, neither is modified.
+    """
+    merged = dict(configs)
+    for key, val in override.items():
+        if isinstance(val, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_configs(merged[key], val)
+        else:
+            merged[key] = val
+    return merged
+
+def normalize_scenario(scenario: dict, default_id) -> dict:
+    """fill in defaults, scenarios are validated
+    when they are solved
+    """
+    return {
+        'id': scenario.get('id', default_id),
+        'cars': scenario.get('cars') or [],
+        't_guess': scenario.get('t_guess'),
+        'config': scenario.get('config') or dict(),
+    }
+
+def read_scenario_dir(dirpath: str) -> dict:
+    """a directory laid out like the repository
+    """
+    t_guess_path = os.path.join(dirpath, 'data', 't_guess.csv')
+    config_path = os.path.join(dirpath, 'config.json')
+    return {
+        'id': os.path.basename(os.path.normpath(dirpath)),
+        'cars': csv2list(os.path.join(dirpath, 'data', 'cars.csv')),
+        't_guess': csv2list(t_guess_path) if os.path.exists(t_guess_path) else None,
+        'config': json2dict(config_path) if os.path.exists(config_path) else None,
+    }
+
+def load_scenarios(path: str) -> list:
+    """`function` load_scenarios
+    ----------------------------
+    Scenarios of a JSON lines file or a directory,
+    ids default to line numbers or file names.
+    """
+    scenarios = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            entry = os.path.join(path, name)
+            if os.path.isdir(entry) and os.path.exists(os.path.join(entry, 'data', 'cars.csv')):
+                scenarios.append(normalize_scenario(read_scenario_dir(entry), name))
+            elif name.endswith('.json'):
+                scenarios.append(normalize_scenario(json2dict(entry), os.path.splitext(name)[0]))
+    else:
+        with open(path, encoding='utf-8') as jsonl_file:
+            for line_index, line in enumerate(jsonl_file):
+                if line.strip():
+                    scenarios.append(normalize_scenario(json.loads(line), line_index+1))
+    return scenarios
@@ -0,0 +1,11 @@
+"""
+================
+Benchmark Module
+================
+
+Synthetic platoons and a runner which solves them with
+the full ALADIN pipeline, one subprocess per configuration.
+
+    python -m benchmark.run --counts 2 4 8 --horizons 8,3 40,20
+
+"""
@@ -0,0 +1,61 @@
+"""
+=================
+Platoon Generator
+=================
+
+Synthetic platoons in the schema of `data/cars.csv`
+and `data/t_guess.csv`, reproducible by seed.
+
+"""
+
+import csv
+import os
+
+import numpy as np
+
+CARS_FIELDS = ['carid', 'P0', 'V0', 'Vref', 'Din', 'Dout', 'Umin', 'Umax']
+T_GUESS_FIELDS = ['carid', 'TinG', 'ToutG']
+
+def generate_platoon(count: int, seed: int = 0, spacing: float = 10.) -> tuple:
+    """`function` generate_platoon
+    ------------------------------
+    Vehicles queue up behind each other on the way to
+    the intersection, `spacing` meters apart on average.
+    Velocities are in km/h like `data/cars.csv`.
+    Time guesses let every vehicle enter after the
+    previous one has left the intersection.
+    """
+    rng = np.random.default_rng(seed)
+
+    cars, t_guess = [], []
+    t_out_prev = 0.
+    for car_index in range(count):
+        init_position = -160. - spacing*car_index + rng.uniform(-2., 2.)
+        init_velocity = rng.uniform(70., 85.)
+        cars.append({
+            'carid': car_index+1,
+            'P0': round(init_position, 3),
+            'V0': round(init_velocity, 3),
+            'Vref': round(rng.uniform(75., 85.), 3),
+            'Din': 0, 'Dout': 10, 'Umin': -2, 'Umax': 2,
+        })
+
+        t_in = max(-init_position/(init_velocity/3.6), t_out_prev+.01)
+        t_out = t_in + 10/(init_velocity/3.6)
+        t_guess.append({'carid': car_index+1, 'TinG': round(t_in, 3), 'ToutG': round(t_out, 3)})
+        t_out_prev = t_out
+
+    return cars, t_guess
+
+def write_platoon(dirpath: str, count: int, seed: int = 0):
+    """write `data/cars.csv` and `data/t_guess.csv` under `dirpath`
+    """
+    cars, t_guess = generate_platoon(count, seed)
+    os.makedirs(os.path.join(dirpath, 'data'), exist_ok=True)
+    for filename, fields, rows in (
+        ('cars.csv', CARS_FIELDS, cars), ('t_guess.csv', T_GUESS_FIELDS, t_guess)
+    ):
+        with open(os.path.join(dirpath, 'data', filename), 'w', newline='', encoding='utf-8') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
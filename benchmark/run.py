@@ -0,0 +1,255 @@
+"""
+================
+Benchmark Runner
+================
+
+Every configuration (vehicle count, N1/N2, mode) is run
+in its own subprocess and temporary working directory,
+holding a synthetic platoon and a modified `config.json`,
+so that nothing is shared between runs and peak RSS
+is measured per run.
+
+    python -m benchmark.run                       # default suite
+    python -m benchmark.run --counts 2 50 200 --horizons 8,3 300,100
+    python -m benchmark.run --write-baseline      # overwrite baseline
+
+Runs are compared against `benchmark/baseline.json`, a run is
+reported as regression if it is `--threshold` times slower.
+Timings only compare on the same machine, so the baseline is not
+part of the repository. The first run writes it, later runs compare
+against it. Rewrite it with `--write-baseline` at the commit to
+compare against. The commit and machine it was written on are kept
+under its `[machine]` key.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark.platoon import write_platoon
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_ROOT, 'benchmark', 'baseline.json')
+
+MODES = {
+    'seq-cached':   {'parallel': False, 'solver_cache': True},
+    'seq-uncached': {'parallel': False, 'solver_cache': False},
+    'par-cached':   {'parallel': True,  'solver_cache': True},
+    'par-uncached': {'parallel': True,  'solver_cache': False},
+    'seq-bfgs':     {'parallel': False, 'solver_cache': True},
+    'par-bfgs':     {'parallel': True,  'solver_cache': True},
+}
+
+# Hessians of STEP 3, exact unless given
+MODE_HESSIAN = {
+    'seq-bfgs': 'bfgs',
+    'par-bfgs': 'bfgs',
+}
+
+STEPS = ['step_{}'.format(step_index) for step_index in range(1, 7)]
+
+MACHINE_KEY = '[machine]'
+
+def get_run_key(count, n1, n2, mode):
+    return '{}x{}+{}/{}'.format(count, n1, n2, mode)
+
+def make_config(count, n1, n2, mode, param_ρ):
+    """`config.json` of the repository with sampling, performance,
+    ρ and instrumentation replaced, without any console output
+    """
+    with open(os.path.join(REPO_ROOT, 'config.json'), encoding='utf-8') as json_file:
+        config = json.load(json_file)
+    config['sampling']['N1'], config['sampling']['N2'] = n1, n2
+    config['performance'].update(MODES[mode])
+    config['aladin']['config']['hessian'] = MODE_HESSIAN.get(mode, 'exact')
+    config['aladin']['para']['ρ'] = param_ρ
+    config['debug']['print_level'] = -1
+    config['debug']['instrument'].update({'enabled': True, 'path': 'instrument.jsonl'})
+    return config
+
+def run_child():
+    """executed inside the temporary working directory,
+    prints the result as one JSON line
+    """
+    import resource
+
+    time_start = time.perf_counter()
+    import intersection
+    summary = intersection.main()
+    time_total = time.perf_counter() - time_start
+
+    records = summary.pop('records')
+    for key in ('τ', 'u', 'λ'):
+        summary.pop(key)
+    print(json.dumps({
+        **summary,
+        't_total': time_total,
+        't_loop': sum(rec.get('t_{}'.format(step), 0.) for rec in records for step in STEPS),
+        't_steps': {
+            step: sum(rec.get('t_{}'.format(step), 0.) for rec in records) for step in STEPS
+        },
+        # KiB on Linux, pool workers are children
+        'rss_self_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'rss_children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }))
+
+def run_config(count, n1, n2, mode, param_ρ=1., seed=0, timeout=None):
+    result = {'key': get_run_key(count, n1, n2, mode), 'count': count, 'N1': n1, 'N2': n2, 'mode': mode}
+
+    with tempfile.TemporaryDirectory(prefix='aladin_bench_') as tmpdir:
+        write_platoon(tmpdir, count, seed)
+        with open(os.path.join(tmpdir, 'config.json'), 'w', encoding='utf-8') as json_file:
+            json.dump(make_config(count, n1, n2, mode, param_ρ), json_file, ensure_ascii=False, indent=4)
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_ROOT, env.get('PYTHONPATH')]))
+        try:
+            child = subprocess.run(
+                [sys.executable, '-m', 'benchmark.run', '--child'],
+                cwd=tmpdir, env=env, capture_output=True, text=True, timeout=timeout
+            )
+        except subprocess.TimeoutExpired:
+            result['error'] = 'timeout after {} s'.format(timeout)
+            return result
+
+    if child.returncode != 0:
+        result['error'] = child.stderr.strip().splitlines()[-1] if child.stderr.strip() else 'exit code {}'.format(child.returncode)
+        return result
+
+    result.update(json.loads(child.stdout.strip().splitlines()[-1]))
+    return result
+
+def get_machine() -> dict:
+    """commit and machine of this run, kept in the baseline
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=REPO_ROOT, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    import casadi
+    return {
+        'commit': commit,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'casadi': casadi.__version__,
+    }
+
+def check_machine(baseline):
+    """warn if the baseline was saved on another machine
+    """
+    base_machine = baseline.get(MACHINE_KEY)
+    if base_machine is None:
+        print('baseline has no machine, rewrite it with --write-baseline')
+        return
+    machine = get_machine()
+    print('baseline of commit {} on {}'.format(base_machine['commit'], base_machine['platform']))
+    if any(base_machine.get(key) != machine[key] for key in ('platform', 'processor', 'cpu_count')):
+        print('baseline is from another machine, rewrite it with --write-baseline')
+
+def compare(results, baseline, threshold):
+    """keys of runs slower than `threshold` times the baseline
+    """
+    regressions = []
+    for result in results:
+        base = baseline.get(result['key'])
+        if base is None or 'error' in result or 'error' in base:
+            continue
+        result['ratio'] = result['t_total'] / base['t_total']
+        if result['ratio'] > threshold:
+            regressions.append(result['key'])
+    return regressions
+
+def print_result(result):
+    if 'error' in result:
+        print('{:<28} ERROR {}'.format(result['key'], result['error']))
+        return
+    print('{:<28} {:>9.3f} {:>9.3f} {:>5} {:>9.1f} {:>6} {:>5} {:>9.1f} {:>7}'.format(
+        result['key'], result['t_total'], result['t_loop'],
+        result['iter_count'], 1e3*result['t_loop']/result['iter_count'],
+        result['ipopt_iter'], 'yes' if result['converged'] else 'no',
+        (result['rss_self_kb'] + result['rss_children_kb']) / 1024,
+        '{:.2f}x'.format(result['ratio']) if 'ratio' in result else '-'
+    ))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='ALADIN intersection benchmark')
+    parser.add_argument('--counts', type=int, nargs='+', default=[2, 4, 8],
+                        help='vehicle counts')
+    parser.add_argument('--horizons', nargs='+', default=['8,3', '40,20'],
+                        help='N1,N2 pairs')
+    parser.add_argument('--modes', nargs='+', default=['seq-cached', 'seq-uncached', 'par-cached'],
+                        choices=list(MODES))
+    parser.add_argument('--seed', type=int, default=0)
+    # with ρ = 0, Tc of a subproblem is unbounded once its λ turns negative
+    parser.add_argument('--rho', type=float, default=1.,
+                        help='ρ of ALADIN, overrides config.json')
+    parser.add_argument('--timeout', type=float, default=1800.,
+                        help='seconds per configuration')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--write-baseline', action='store_true',
+                        help='overwrite the baseline, written on the first run anyway')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='slowdown against baseline reported as regression')
+    parser.add_argument('--output', help='write all results as JSON lines')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        run_child()
+        return 0
+
+    baseline = dict()
+    write_baseline = args.write_baseline or not os.path.exists(args.baseline)
+    if write_baseline:
+        print('writing baseline {}'.format(args.baseline))
+    else:
+        with open(args.baseline, encoding='utf-8') as json_file:
+            baseline = json.load(json_file)
+        check_machine(baseline)
+
+    print('{:<28} {:>9} {:>9} {:>5} {:>9} {:>6} {:>5} {:>9} {:>7}'.format(
+        'configuration', 'total [s]', 'loop [s]', 'iter', 'iter [ms]', 'ipopt', 'conv', 'RSS [MiB]', 'vs base'
+    ))
+    results = []
+    for horizon in args.horizons:
+        n1, n2 = (int(n) for n in horizon.split(','))
+        for count in args.counts:
+            for mode in args.modes:
+                result = run_config(count, n1, n2, mode, args.rho, args.seed, args.timeout)
+                compare([result], baseline, args.threshold)
+                print_result(result)
+                results.append(result)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as jsonl_file:
+            for result in results:
+                jsonl_file.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    if write_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as json_file:
+            json.dump(
+                {MACHINE_KEY: get_machine(), **{result['key']: result for result in results}},
+                json_file, ensure_ascii=False, indent=4
+            )
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for key in regressions:
+        print('regression: {}'.format(key))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
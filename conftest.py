@@ -0,0 +1,33 @@
+"""
+pytest fixtures, the repository root is on `sys.path` so that
+tests import modules the way the scripts do
+"""
+import json
+import os
+import shutil
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture
+def problem_dir(tmp_path):
+    """copy of `config.json` and `data/` without console output,
+    `configs` is written back by `problem_dir.write`
+    """
+    shutil.copytree(os.path.join(REPO_ROOT, 'data'), tmp_path / 'data')
+    with open(os.path.join(REPO_ROOT, 'config.json'), encoding='utf-8') as json_file:
+        configs = json.load(json_file)
+    configs['debug']['print_level'] = -1
+    return ProblemDir(tmp_path, configs)
+
+class ProblemDir:
+    def __init__(self, path, configs):
+        self.path = path
+        self.configs = configs
+        self.write()
+
+    def write(self):
+        with open(self.path / 'config.json', 'w', encoding='utf-8') as json_file:
+            json.dump(self.configs, json_file, ensure_ascii=False, indent=4)
+        return str(self.path)
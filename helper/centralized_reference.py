@@ -1,11 +1,171 @@
+"""
+============================
+Centralized Reference Helper
+============================
+
+Initial τ, u and λ of ALADIN for any number of vehicles.
+
+    constant_acceleration
+        closed form from `data/t_guess.csv`, every vehicle
+        accelerates constantly to reach Din at TinG and Dout
+        at ToutG.
+    centralized
+        the coupled problem of all vehicles is solved once
+        with coarse N1 / N2, started from the closed form.
+        τ, interpolated u and rescaled duals of the coupling
+        are used.
+
+"""
+
+import copy
+
 import numpy as np
 import casadi as ca
 
-from problem import SAMPLE_N1, SAMPLE_N2, SUB_SYS_COUNT, V_INITS
+from problem import IPOPT_SETTING, SYMBOL_DEBUG, ProblemInstance
+from helper import constructor
+from helper.colorize import color_print
+from helper.subsystype import SubSystemType, get_sub_system_type
+
+def get_guess_τ(instance):
+    """τ from `t_guess`, Tc is where the next vehicle enters,
+    or Tout if that is earlier
+    """
+    t_guess, sub_sys_count = instance.t_guess, instance.sub_sys_count
+    var_τ = []
+    for sub_index in range(sub_sys_count):
+        τ = [t_guess[sub_index]['TinG'], t_guess[sub_index]['ToutG']]
+        if get_sub_system_type(sub_sys_count, sub_index) in (SubSystemType.head, SubSystemType.body):
+            τ += [max(τ[1], t_guess[sub_index+1]['TinG'])]
+        var_τ.append(np.array(τ, dtype=float))
+    return var_τ
+
+def get_constant_acceleration(sub_known, t_in, t_out, sample_n1, sample_n2):
+    """u of constant acceleration before and after entry, clipped to bounds
+    Din = P0 + V0 Tin + a1 Tin²/2
+    Dout = Din + Vin (Tout-Tin) + a2 (Tout-Tin)²/2
+    """
+    acc_1 = 2*(sub_known['Din'] - sub_known['P0'] - sub_known['V0']*t_in) / t_in**2
+    velocity_in = sub_known['V0'] + acc_1*t_in
+    len_t_2 = t_out - t_in
+    acc_2 = 2*(sub_known['Dout'] - sub_known['Din'] - velocity_in*len_t_2) / len_t_2**2
+    return np.clip(
+        np.array([acc_1]*sample_n1 + [acc_2]*sample_n2),
+        sub_known['Umin'], sub_known['Umax']
+    )
+
+def get_guess_λ(instance):
+    """λ of `aladin.guess` in `config.json` if long enough, ones otherwise
+    """
+    sign = 1 if SYMBOL_DEBUG else -1
+    guess_λ = instance.configs['aladin']['guess']['λ']
+    if len(guess_λ) >= instance.sub_sys_count-1:
+        return sign*np.array(guess_λ[:instance.sub_sys_count-1], dtype=float)
+    return sign*np.ones(instance.sub_sys_count-1)
+
+def get_constant_acceleration_guess(instance, sample_n1=None, sample_n2=None):
+    """`function` get_constant_acceleration_guess
+    ---------------------------------------------
+    Closed-form τ, u and λ from `t_guess`.
+    """
+    sample_n1 = instance.sample_n1 if sample_n1 is None else sample_n1
+    sample_n2 = instance.sample_n2 if sample_n2 is None else sample_n2
+    var_τ = get_guess_τ(instance)
+    var_u = [
+        get_constant_acceleration(sub_known, τ[0], τ[1], sample_n1, sample_n2)
+        for sub_known, τ in zip(instance.v_inits, var_τ)
+    ]
+    return var_τ, var_u, get_guess_λ(instance)
+
+def interpolate_control(u, sample_n1, sample_n2, coarse_n1, coarse_n2):
+    """piecewise constant coarse controls on the fine grid, phase by phase
+    """
+    return np.concatenate((
+        u[(np.arange(sample_n1)*coarse_n1) // sample_n1],
+        u[coarse_n1 + (np.arange(sample_n2)*coarse_n2) // sample_n2],
+    ))
+
+def get_centralized_guess(instance):
+    """`function` get_centralized_guess
+    -----------------------------------
+    Solve the coupled problem of all vehicles with coarse N1 / N2.
+
+    Templates of the coarse problem are not kept in the per-process
+    cache of `helper.constructor`, they are built for this solve only.
+
+    The cost of a vehicle is a sum over its N1 + N2 + 1 samples, not
+    weighted by their length, so the cost and its sensitivity to the
+    coupled times grow about linearly with the number of samples.
+    Duals of the coupling are scaled by the ratio of fine to coarse
+    sample counts, which is a heuristic only, ALADIN corrects λ.
+    """
+    guess_cfgs = instance.guess_cfgs
+    coarse_n1, coarse_n2 = guess_cfgs['COARSE_N1'], guess_cfgs['COARSE_N2']
+    sub_sys_count = instance.sub_sys_count
+
+    configs = copy.deepcopy(instance.configs)
+    configs['sampling'].update({'N1': coarse_n1, 'N2': coarse_n2})
+    # only the stacked problem is solved, no subproblem solvers are needed
+    configs['performance']['solver_cache'] = False
+    configs['performance']['codegen']['enabled'] = False
+    coarse_instance = ProblemInstance(instance.base_dir, configs=configs, cars=instance.cars, t_guess=instance.t_guess)
+
+    coarse_templates = dict()
+    nlp_struct = [
+        constructor.build_nlp_struct(sub_index, instance=coarse_instance, templates=coarse_templates)
+        for sub_index in range(sub_sys_count)
+    ]
+    var_τ, var_u, var_λ = get_constant_acceleration_guess(instance, coarse_n1, coarse_n2)
+
+    # structs of one type share their symbols, every vehicle gets its own
+    x_list = [ca.MX.sym('x_{}'.format(sub_index+1), struct['x'].shape[0]) for sub_index, struct in enumerate(nlp_struct)]
+    cost_list, g_list = zip(*[struct['cost_func'](x_i, struct['vehicle_val']) for struct, x_i in zip(nlp_struct, x_list)])
+
+    # TiC - Ti+1In = 0
+    g_coupling = [x_list[sub_index][2] - x_list[sub_index+1][0] for sub_index in range(sub_sys_count-1)]
+    x0 = [
+        ca.vertcat(τ, u) if struct['state_func'] is None
+        else ca.vertcat(τ, u, struct['state_func'](τ, u, struct['vehicle_val']))
+        for struct, τ, u in zip(nlp_struct, var_τ, var_u)
+    ]
+    nlp = {
+        'x': ca.vertcat(*x_list),
+        'f': sum(cost_list),
+        'g': ca.vertcat(*g_coupling, *g_list),
+    }
+    solver = ca.nlpsol('centralized', 'ipopt', nlp, IPOPT_SETTING)
+    opt_sol = solver(
+        x0=ca.vertcat(*x0),
+        lbx=sum((struct['lbx'] for struct in nlp_struct), []),
+        ubx=sum((struct['ubx'] for struct in nlp_struct), []),
+        lbg=[0]*len(g_coupling) + sum((struct['lbg'] for struct in nlp_struct), []),
+        ubg=[0]*len(g_coupling) + sum((struct['ubg'] for struct in nlp_struct), []),
+    )
+    if not solver.stats()['success']:
+        color_print('warning', 1, 'centralized reference failed ({}), using closed form', solver.stats()['return_status'])
+        return get_constant_acceleration_guess(instance)
 
-# def get_centralized_reference():
+    x_opt = opt_sol['x'].full()[:, 0]
+    x_offsets = np.cumsum([0] + [struct['x'].shape[0] for struct in nlp_struct])
+    var_τ, var_u = [], []
+    for sub_index, struct in enumerate(nlp_struct):
+        n_τ, n_u = struct['xt'].shape[0], struct['xu'].shape[0]
+        x_i = x_opt[x_offsets[sub_index]:x_offsets[sub_index+1]]
+        var_τ.append(x_i[:n_τ])
+        var_u.append(interpolate_control(x_i[n_τ:n_τ+n_u], instance.sample_n1, instance.sample_n2, coarse_n1, coarse_n2))
 
-#     for v_index in range(SUB_SYS_COUNT):
+    # costs sum over samples, so duals grow with N, see above
+    var_λ = (1 if SYMBOL_DEBUG else -1) * opt_sol['lam_g'].full()[:sub_sys_count-1, 0] \
+        * (instance.sample_n1+instance.sample_n2+1) / (coarse_n1+coarse_n2+1)
 
-#         init_p = 
+    color_print('ok', 2, 'centralized reference solved in {} IPOPT iterations', solver.stats()['iter_count'])
+    return var_τ, var_u, var_λ
 
+def get_initial_guess(instance):
+    """`function` get_initial_guess
+    -------------------------------
+    τ, u and λ to start ALADIN from, by `aladin.guess.method`.
+    """
+    if instance.guess_cfgs['METHOD'] == 'centralized' and instance.sub_sys_count > 1:
+        return get_centralized_guess(instance)
+    return get_constant_acceleration_guess(instance)
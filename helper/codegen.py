@@ -0,0 +1,105 @@
+"""
+==============
+Codegen Helper
+==============
+
+CasADi functions evaluated as compiled C instead of the MX
+virtual machine. C code is generated once, compiled with the
+system compiler into a shared object and kept on disk under
+`cache_dir`, named by a hash of the serialized function, the
+compiler and its flags. Later runs and worker processes load
+the shared object directly.
+
+If compiling fails, the original function is used.
+
+"""
+
+import hashlib
+import os
+import subprocess
+import tempfile
+
+import casadi as ca
+
+from helper.colorize import color_print
+
+def get_function_hash(func: ca.Function, codegen_cfgs: dict) -> str:
+    """`function` get_function_hash
+    -------------------------------
+    Equal structure and numerical constants give equal hashes.
+    """
+    digest = hashlib.sha256(func.serialize().encode('utf-8'))
+    digest.update(repr((ca.__version__, codegen_cfgs['COMPILER'], codegen_cfgs['FLAGS'])).encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+def compile_library(lib_path: str, funcs: list, codegen_cfgs: dict) -> bool:
+    """`function` compile_library
+    -----------------------------
+    C code of `funcs` is generated and compiled to `lib_path`.
+    The shared object is moved into place at the end, so that
+    processes compiling at the same time do not clash.
+    """
+    if os.path.exists(lib_path):
+        return True
+    os.makedirs(os.path.dirname(lib_path), exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(lib_path)) as tmpdir:
+        code_gen = ca.CodeGenerator('gen')
+        for func in funcs:
+            code_gen.add(func)
+        c_path = code_gen.generate(tmpdir + os.sep)
+
+        color_print('info', 2, 'Compiling {}', os.path.basename(lib_path))
+        try:
+            subprocess.run(
+                [codegen_cfgs['COMPILER'], '-fPIC', '-shared', *codegen_cfgs['FLAGS'],
+                 c_path, '-o', os.path.join(tmpdir, 'gen.so')],
+                check=True, capture_output=True
+            )
+        except (OSError, subprocess.CalledProcessError) as err:
+            stderr = getattr(err, 'stderr', None)
+            color_print(
+                'warning', 0, 'Compiling {} failed, falling back to MX: {}',
+                os.path.basename(lib_path), stderr.decode(errors='replace').strip() if stderr else err
+            )
+            return False
+        os.replace(os.path.join(tmpdir, 'gen.so'), lib_path)
+    return True
+
+def compile_function(func: ca.Function, codegen_cfgs: dict) -> ca.Function:
+    """`function` compile_function
+    ------------------------------
+    `func` loaded from its shared object, or `func`
+    itself if code generation is disabled or fails.
+    """
+    if not codegen_cfgs or not codegen_cfgs['ENABLED']:
+        return func
+    lib_path = os.path.join(
+        codegen_cfgs['CACHE_DIR'], '{}_{}.so'.format(func.name(), get_function_hash(func, codegen_cfgs))
+    )
+    if not compile_library(lib_path, [func], codegen_cfgs):
+        return func
+    return ca.external(func.name(), lib_path)
+
+def compile_nlp(nlp: dict, codegen_cfgs: dict):
+    """`function` compile_nlp
+    -------------------------
+    Path of the shared object holding the IPOPT callbacks of
+    `nlp` (objective, constraints, their derivatives and the
+    Lagrangian Hessian), which `ca.nlpsol` accepts in place of
+    `nlp`. `None` if code generation is disabled or fails.
+    Solver options do not change the callbacks, so solvers
+    with and without warm start share the shared object.
+    """
+    if not codegen_cfgs or not codegen_cfgs['ENABLED']:
+        return None
+    nlp_func = ca.Function('nlp', [nlp['x'], nlp['p']], [nlp['f'], nlp['g']])
+    lib_path = os.path.join(
+        codegen_cfgs['CACHE_DIR'], 'nlp_{}.so'.format(get_function_hash(nlp_func, codegen_cfgs))
+    )
+    if not os.path.exists(lib_path):
+        nlp_solver = ca.nlpsol('S', 'ipopt', nlp)
+        funcs = [nlp_solver.oracle()] + [nlp_solver.get_function(name) for name in nlp_solver.get_function()]
+        if not compile_library(lib_path, funcs, codegen_cfgs):
+            return None
+    return lib_path
@@ -1,23 +1,130 @@
+"""
+===============
+Colorize Helper
+===============
+
+Leveled console output, and an optional JSON lines sink.
+
+Messages are `str.format` templates, arguments are only
+formatted if the message is printed or logged at its level,
+so that MX expressions and long arrays cost nothing otherwise.
+
+    color_print('debug', 3, '[{}] τ updated {}', sub_index+1, var_τ)
+
+Keyword arguments are formatted as well, and also written
+to the sink as `data` of the record. Console lines are
+buffered and written to `sys.stdout` of the time of flushing,
+the sink is written when the buffer is flushed, too.
+
+Nothing is read from `config.json` here, entry points set the
+print level and sink of their instance with `configure_log`,
+until then only messages up to `DEFAULT_PRINT_LEVEL` are printed.
+
+"""
+
+import atexit
+import json
+import sys
+import threading
+import time
+
 import colorama
-from problem import PRINT_LEVEL
+import numpy as np
+
+DEFAULT_PRINT_LEVEL = 0
+
+_print_level = DEFAULT_PRINT_LEVEL
+
+_sink = {'path': None, 'level': -1, 'file': None}
+_buffer_size = 64
+_console_buffer = []
+_sink_buffer = []
+_lock = threading.Lock()
+
+def set_print_level(level):
+    global _print_level
+    _print_level = level
 
-def color_print(category, level, msg):
+def set_log_sink(path, level=1, buffer_size=None):
+    """`function` set_log_sink
+    --------------------------
+    Append records up to `level` to the JSON lines file
+    `path`, `None` turns the sink off.
+    """
+    global _buffer_size
+    flush_log()
+    with _lock:
+        if _sink['file'] is not None:
+            _sink['file'].close()
+        _sink.update({'path': path, 'level': level if path else -1, 'file': None})
+        if buffer_size is not None:
+            _buffer_size = max(1, buffer_size)
+
+def configure_log(instance):
+    """print level and sink of `instance`
+    """
+    set_print_level(instance.print_level)
+    log_cfgs = instance.log_cfgs
+    set_log_sink(log_cfgs['PATH'] or None, log_cfgs['LEVEL'], log_cfgs['BUFFER'])
+
+def is_print_enabled(level) -> bool:
+    """whether a message of `level` is printed or logged
+    """
+    return level <= _print_level or level <= _sink['level']
+
+def _to_json(val):
+    if isinstance(val, np.ndarray):
+        return val.tolist()
+    if isinstance(val, np.generic):
+        return val.item()
+    return str(val)
+
+def flush_log():
+    """write buffered console lines and records
+    """
+    with _lock:
+        if _console_buffer:
+            sys.stdout.write(''.join(_console_buffer))
+            sys.stdout.flush()
+            _console_buffer.clear()
+        if _sink_buffer:
+            if _sink['file'] is None:
+                _sink['file'] = open(_sink['path'], 'a', encoding='utf-8')
+            _sink['file'].write(''.join(_sink_buffer))
+            _sink['file'].flush()
+            _sink_buffer.clear()
+
+atexit.register(flush_log)
+
+def color_print(category, level, msg, *args, **fields):
     """print colorized console output
     """
-    if level <= PRINT_LEVEL:
-        print(msg)
-        """ unknown problem was caused by colorama
-        colorama.init()
-        if category == 'ok':
-            print(colorama.Fore.GREEN  + '[   OK ]' + colorama.Style.RESET_ALL, msg)
-        elif category == 'info':
-            print(colorama.Fore.CYAN   + '[ INFO ]' + colorama.Style.RESET_ALL, msg)
-        elif category == 'warning':
-            print(colorama.Fore.YELLOW + '[ WARN ]' + colorama.Style.RESET_ALL, msg)
-        elif category == 'error':
-            print(colorama.Fore.RED    + '[  ERR ]' + colorama.Style.RESET_ALL, msg)
-        elif category == 'debug':
-            print(colorama.Fore.BLUE   + '_debug__' + colorama.Style.RESET_ALL, msg)
-        """
-    else:
-        pass
+    if not is_print_enabled(level):
+        return
+    if args or fields:
+        msg = msg.format(*args, **fields)
+
+    with _lock:
+        if level <= _print_level:
+            _console_buffer.append(msg + '\n')
+        if level <= _sink['level']:
+            _sink_buffer.append(json.dumps({
+                'time': time.time(), 'category': category, 'level': level, 'msg': msg, 'data': fields
+            }, ensure_ascii=False, default=_to_json) + '\n')
+        should_flush = len(_console_buffer) + len(_sink_buffer) >= _buffer_size \
+            or category in ('warning', 'error')
+    if should_flush:
+        flush_log()
+    """ unknown problem was caused by colorama
+    colorama.init()
+    if category == 'ok':
+        print(colorama.Fore.GREEN  + '[   OK ]' + colorama.Style.RESET_ALL, msg)
+    elif category == 'info':
+        print(colorama.Fore.CYAN   + '[ INFO ]' + colorama.Style.RESET_ALL, msg)
+    elif category == 'warning':
+        print(colorama.Fore.YELLOW + '[ WARN ]' + colorama.Style.RESET_ALL, msg)
+    elif category == 'error':
+        print(colorama.Fore.RED    + '[  ERR ]' + colorama.Style.RESET_ALL, msg)
+    elif category == 'debug':
+        print(colorama.Fore.BLUE   + '_debug__' + colorama.Style.RESET_ALL, msg)
+    """
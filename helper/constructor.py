@@ -2,16 +2,21 @@ import numpy as np
 import casadi as ca
 
 from helper.colorize import color_print
+from helper.codegen import compile_nlp
 from helper.subsystype import SubSystemType, get_sub_system_type
-from helper.discretize import get_sampling_interval_length, get_discretized_dynamics
+from helper.discretize import get_sampling_interval_length, get_discretized_dynamics, get_condensed_dynamics
 
-from problem import CONFIGS, SUB_SYS_COUNT, SAMPLE_N1, SAMPLE_N2, V_INITS, SYMBOL_DEBUG
+from problem import SYMBOL_DEBUG, IPOPT_SETTING, IPOPT_WARM_SETTING, get_instance
 
-def build_nlp_time_related(v_index, sub_sys_type):
+# vehicle data entering the NLP as parameters, in this order,
+# Umin and Umax only enter the bounds of u
+VEHICLE_PARAM_NAMES = ['P0', 'V0', 'Vref', 'Din', 'Dout']
+
+def build_nlp_time_related(sub_sys_type):
 
     # form Tin and Tout
-    t_in = ca.MX.sym('Tin_{}'.format(v_index+1))
-    t_out = ca.MX.sym('Tout_{}'.format(v_index+1))
+    t_in = ca.MX.sym('Tin')
+    t_out = ca.MX.sym('Tout')
 
     # construct full τ and corresponding constraints
     # notice that time should be positive
@@ -20,7 +25,7 @@ def build_nlp_time_related(v_index, sub_sys_type):
 
     if sub_sys_type in (SubSystemType.head, SubSystemType.body):
         # add copy variable to sub-system
-        t_c = ca.MX.sym('Tc_{}'.format(v_index+1))
+        t_c = ca.MX.sym('Tc')
         x_τ_xτ = ca.vertcat(x_τ_xτ, t_c)
         x_τ_lb += [0]
         x_τ_ub += [np.inf]
@@ -41,29 +46,27 @@ def build_nlp_time_related(v_index, sub_sys_type):
     return x_τ_xτ, x_τ_lb, x_τ_ub, g_τ_gτ, g_τ_lb, g_τ_ub, t_in, t_out, t_c
 
 
-def build_nlp_control_related(v_index, sub_sys_type, t_in, t_out):
-    sub_known = V_INITS[v_index]
+def build_nlp_control_related(sub_sys_type, t_in, t_out, p_d, instance):
+    sample_n1, sample_n2 = instance.sample_n1, instance.sample_n2
 
     # Read known values
-    init_position = sub_known['P0']
-    init_velocity = sub_known['V0']
-    ref_velocity = sub_known['Vref']
-    control_lb, control_ub = sub_known['Umin'], sub_known['Umax']
-    d_in, d_out = sub_known['Din'], sub_known['Dout']
+    init_position, init_velocity, ref_velocity, d_in, d_out = ca.vertsplit(p_d)
+    # bounds of u are set per vehicle
+    control_lb, control_ub = -np.inf, np.inf
 
     # construct initial state
     state_i = ca.vertcat(init_position, init_velocity)
 
     cost_fn = (state_i[1]-ref_velocity)**2
 
-    len_t_s = get_sampling_interval_length(t_in, t_out, SAMPLE_N1, SAMPLE_N2, False)
+    len_t_s = get_sampling_interval_length(t_in, t_out, sample_n1, sample_n2, False)
     dmat_a, dmat_b = get_discretized_dynamics(len_t_s)
 
     x_u_xu, x_u_lb, x_u_ub = ca.MX.zeros(0, 0), [], []
     g_u_gu, g_u_lb, g_u_ub = ca.MX.zeros(0, 0), [], []
 
-    for u_index in range(SAMPLE_N1+SAMPLE_N2):
-        control_i = ca.MX.sym('u{}_{}'.format(u_index, v_index+1))
+    for u_index in range(sample_n1+sample_n2):
+        control_i = ca.MX.sym('u{}'.format(u_index))
         x_u_xu = ca.vertcat(x_u_xu, control_i)
         x_u_lb += [control_lb]
         x_u_ub += [control_ub]
@@ -73,15 +76,15 @@ def build_nlp_control_related(v_index, sub_sys_type, t_in, t_out):
         cost_fn += (state_i[1]-ref_velocity)**2 + control_i**2
 
         # critical points, N1 and N2
-        if u_index+1 == SAMPLE_N1:
+        if u_index+1 == sample_n1:
             position_entry = state_i[0]
             g_u_gu = ca.vertcat(g_u_gu, position_entry-d_in)
             g_u_lb += [0]
             g_u_ub += [0]
             # obtain sampling time interval after entry
-            len_t_s = get_sampling_interval_length(t_in, t_out, SAMPLE_N1, SAMPLE_N2, True)
+            len_t_s = get_sampling_interval_length(t_in, t_out, sample_n1, sample_n2, True)
             dmat_a, dmat_b = get_discretized_dynamics(len_t_s)
-        elif u_index+1 == SAMPLE_N1+SAMPLE_N2:
+        elif u_index+1 == sample_n1+sample_n2:
             position_exit = state_i[0]
             g_u_gu = ca.vertcat(g_u_gu, position_exit-d_out)
             g_u_lb += [0]
@@ -92,39 +95,307 @@ def build_nlp_control_related(v_index, sub_sys_type, t_in, t_out):
     return x_u_xu, x_u_lb, x_u_ub, g_u_gu, g_u_lb, g_u_ub, cost_fn
 
 
-def build_nlp_struct(v_index):
-    """build_nlp_struct
-    Given initial velocity and position,
-    build variables and constraint needed in solving NLP
+def build_nlp_control_related_condensed(sub_sys_type, t_in, t_out, p_d, instance):
+    """build_nlp_control_related_condensed
+    Same as `build_nlp_control_related`, but positions and velocities
+    are closed-form sums over the controls, built with SX and called
+    with MX, instead of being rolled forward step by step.
     """
-    color_print(
-        'info', 3,
-        'Building NLP struct for vehicle {}.'.format(v_index+1)
+    sample_n1, sample_n2 = instance.sample_n1, instance.sample_n2
+
+    x_u_xu = ca.vertcat(*[
+        ca.MX.sym('u{}'.format(u_index))
+        for u_index in range(sample_n1+sample_n2)
+    ])
+    # bounds of u are set per vehicle
+    x_u_lb = [-np.inf]*(sample_n1+sample_n2)
+    x_u_ub = [np.inf]*(sample_n1+sample_n2)
+
+    sx_t_in, sx_t_out = ca.SX.sym('Tin'), ca.SX.sym('Tout')
+    sx_u = ca.SX.sym('u', sample_n1+sample_n2)
+    sx_d = ca.SX.sym('d', len(VEHICLE_PARAM_NAMES))
+
+    # Read known values
+    init_position, init_velocity, ref_velocity, d_in, d_out = ca.vertsplit(sx_d)
+
+    # before entry, N1 samples
+    len_t_s = get_sampling_interval_length(sx_t_in, sx_t_out, sample_n1, sample_n2, False)
+    position_1, velocity_1 = get_condensed_dynamics(len_t_s, init_position, init_velocity, sx_u[:sample_n1])
+
+    # after entry, N2 samples
+    len_t_s = get_sampling_interval_length(sx_t_in, sx_t_out, sample_n1, sample_n2, True)
+    position_2, velocity_2 = get_condensed_dynamics(len_t_s, position_1[-1], velocity_1[-1], sx_u[sample_n1:])
+
+    velocity = ca.vertcat(velocity_1, velocity_2)
+    sx_cost_fn = (init_velocity-ref_velocity)**2 + ca.sumsqr(velocity-ref_velocity) + ca.sumsqr(sx_u)
+    sx_cost_fn /= sx_t_out
+
+    # critical points, N1 and N2
+    sx_g_u_gu = ca.vertcat(position_1[-1]-d_in, position_2[-1]-d_out)
+
+    condensed = ca.Function(
+        'condensed_{}'.format(sub_sys_type.name),
+        [sx_t_in, sx_t_out, sx_u, sx_d], [sx_cost_fn, sx_g_u_gu]
     )
+    cost_fn, g_u_gu = condensed(t_in, t_out, x_u_xu, p_d)
+
+    return x_u_xu, x_u_lb, x_u_ub, g_u_gu, [0]*2, [0]*2, cost_fn
+
+
+def build_nlp_control_related_multiple_shooting(sub_sys_type, t_in, t_out, p_d, instance):
+    """build_nlp_control_related_multiple_shooting
+    States after every sample are NLP variables, ordered as
+    [p1, v1, p2, v2, ...], and the dynamics enter as equality
+    constraints. Constraint Jacobian and Lagrangian Hessian are
+    then banded instead of dense.
+    """
+    sample_n1, sample_n2 = instance.sample_n1, instance.sample_n2
 
-    sub_sys_type = get_sub_system_type(SUB_SYS_COUNT, v_index)
+    # Read known values
+    init_position, init_velocity, ref_velocity, d_in, d_out = ca.vertsplit(p_d)
+
+    x_u_xu = ca.vertcat(*[
+        ca.MX.sym('u{}'.format(u_index))
+        for u_index in range(sample_n1+sample_n2)
+    ])
+    # bounds of u are set per vehicle
+    x_u_lb = [-np.inf]*(sample_n1+sample_n2)
+    x_u_ub = [np.inf]*(sample_n1+sample_n2)
+
+    x_s_xs = ca.MX.sym('s', 2*(sample_n1+sample_n2))
+    x_s_lb = [-np.inf]*2*(sample_n1+sample_n2)
+    x_s_ub = [np.inf]*2*(sample_n1+sample_n2)
+
+    # construct initial state
+    state_i = ca.vertcat(init_position, init_velocity)
+
+    cost_fn = (state_i[1]-ref_velocity)**2
+
+    len_t_s = get_sampling_interval_length(t_in, t_out, sample_n1, sample_n2, False)
+    dmat_a, dmat_b = get_discretized_dynamics(len_t_s)
+
+    g_s_gs = []
+
+    for u_index in range(sample_n1+sample_n2):
+        control_i = x_u_xu[u_index]
+        state_n = x_s_xs[2*u_index:2*u_index+2]
+
+        # x_{k+1} = A(t_s)x_k + B(t_s)u_k
+        g_s_gs += [state_n - (dmat_a@state_i + dmat_b@control_i)]
+        state_i = state_n
+
+        cost_fn += (state_i[1]-ref_velocity)**2 + control_i**2
+
+        if u_index+1 == sample_n1:
+            # obtain sampling time interval after entry
+            len_t_s = get_sampling_interval_length(t_in, t_out, sample_n1, sample_n2, True)
+            dmat_a, dmat_b = get_discretized_dynamics(len_t_s)
+
+    cost_fn /= t_out
+
+    # critical points, N1 and N2
+    g_u_gu = ca.vertcat(
+        *g_s_gs,
+        x_s_xs[2*(sample_n1-1)]-d_in,
+        x_s_xs[2*(sample_n1+sample_n2-1)]-d_out
+    )
+    g_u_lb = [0]*g_u_gu.shape[0]
+    g_u_ub = [0]*g_u_gu.shape[0]
+
+    return x_u_xu, x_u_lb, x_u_ub, x_s_xs, x_s_lb, x_s_ub, g_u_gu, g_u_lb, g_u_ub, cost_fn
+
+
+def build_state_rollout(sub_sys_type, instance):
+    """build_state_rollout
+    Function from (τ, u, vehicle data) to states [p1, v1, p2, v2, ...],
+    used to initialize state variables of multiple shooting.
+    """
+    sample_n1, sample_n2 = instance.sample_n1, instance.sample_n2
+
+    sx_τ = ca.SX.sym('τ', 3 if sub_sys_type in (SubSystemType.head, SubSystemType.body) else 2)
+    sx_u = ca.SX.sym('u', sample_n1+sample_n2)
+    sx_d = ca.SX.sym('d', len(VEHICLE_PARAM_NAMES))
+
+    len_t_s = get_sampling_interval_length(sx_τ[0], sx_τ[1], sample_n1, sample_n2, False)
+    position_1, velocity_1 = get_condensed_dynamics(len_t_s, sx_d[0], sx_d[1], sx_u[:sample_n1])
+    len_t_s = get_sampling_interval_length(sx_τ[0], sx_τ[1], sample_n1, sample_n2, True)
+    position_2, velocity_2 = get_condensed_dynamics(len_t_s, position_1[-1], velocity_1[-1], sx_u[sample_n1:])
+
+    states = ca.horzcat(ca.vertcat(position_1, position_2), ca.vertcat(velocity_1, velocity_2))
+
+    return ca.Function('states_{}'.format(sub_sys_type.name), [sx_τ, sx_u, sx_d], [ca.vec(states.T)])
+
+
+def get_λ_index(v_index, sub_sys_type):
+    """get_λ_index
+    λ_{i-1} couples Tin, λ_i couples Tc
+    """
+    λ_index = []
+    if sub_sys_type in (SubSystemType.body, SubSystemType.tail):
+        λ_index += [v_index-1]
+    if sub_sys_type in (SubSystemType.head, SubSystemType.body):
+        λ_index += [v_index]
+    return λ_index
+
+
+def build_nlp_param_related(sub_sys_type, x_τ_xτ, t_in, t_c):
+    """build_nlp_param_related
+    Values changing on every ALADIN iteration (τ, neighbouring λ and ρ)
+    enter the NLP as parameters, so that the solver is built only once.
+    λ has as many entries as couplings of the subsystem type.
+    """
+    p_τ = ca.MX.sym('τ', x_τ_xτ.shape[0])
+    p_ρ = ca.MX.sym('ρ')
+
+    # NOTE `+λTc-λTin` or `-λTc+λTin` depends on the symbol of λ
+    λ_sign = 1 if SYMBOL_DEBUG else -1
+    λ_term = []
+    if sub_sys_type in (SubSystemType.body, SubSystemType.tail):
+        λ_term += [-λ_sign*t_in]
+    if sub_sys_type in (SubSystemType.head, SubSystemType.body):
+        λ_term += [λ_sign*t_c]
+    p_λ = ca.MX.sym('λ', len(λ_term))
+
+    param_fn = p_ρ/2 * ca.dot(x_τ_xτ-p_τ, x_τ_xτ-p_τ)
+    if λ_term:
+        param_fn += ca.dot(p_λ, ca.vertcat(*λ_term))
+
+    return ca.vertcat(p_τ, p_λ, p_ρ), param_fn
+
+
+"""
+NLP templates
+-------------
+Vehicle data are NLP parameters, so that all vehicles of one subsystem
+type share the symbolic NLP, its solvers and derivative functions.
+Templates are kept per process, keyed by everything they depend on.
+Callers building one-off templates, like the coarse problem of
+`helper.centralized_reference`, pass their own `templates` instead.
+"""
+_nlp_templates = dict()
+
+def get_template_key(sub_sys_type, condensed, instance) -> tuple:
+    return (
+        sub_sys_type, instance.sample_n1, instance.sample_n2,
+        instance.formulation_cfgs['SHOOTING'], condensed,
+        instance.solver_cache, instance.aladin_cfgs['WARM_START'],
+        tuple(sorted((key, repr(val)) for key, val in instance.codegen_cfgs.items())),
+    )
+
+def get_template_count() -> int:
+    """number of NLP templates built in this process
+    """
+    return len(_nlp_templates)
+
+def build_nlp_template(sub_sys_type, condensed, instance):
+    """build_nlp_template
+    Build variables and constraints of a subsystem type, with
+    vehicle data and coordination values as parameters
+    """
+    color_print('info', 3, 'Building NLP template for {}.', sub_sys_type.name)
 
     # time related first
-    x_τ_xτ, x_τ_lb, x_τ_ub, g_τ_gτ, g_τ_lb, g_τ_ub, t_in, t_out, t_c = build_nlp_time_related(v_index, sub_sys_type)
+    x_τ_xτ, x_τ_lb, x_τ_ub, g_τ_gτ, g_τ_lb, g_τ_ub, t_in, t_out, t_c = build_nlp_time_related(sub_sys_type)
     # control related second
-    x_u_xu, x_u_lb, x_u_ub, g_u_gu, g_u_lb, g_u_ub, cost_fn = build_nlp_control_related(v_index, sub_sys_type, t_in, t_out)
+    p_d = ca.MX.sym('d', len(VEHICLE_PARAM_NAMES))
+    if instance.formulation_cfgs['SHOOTING'] == 'multiple':
+        x_u_xu, x_u_lb, x_u_ub, x_s_xs, x_s_lb, x_s_ub, g_u_gu, g_u_lb, g_u_ub, cost_fn = build_nlp_control_related_multiple_shooting(sub_sys_type, t_in, t_out, p_d, instance)
+        state_func = build_state_rollout(sub_sys_type, instance)
+    else:
+        x_u_xu, x_u_lb, x_u_ub, g_u_gu, g_u_lb, g_u_ub, cost_fn = build_nlp_control_related_condensed(sub_sys_type, t_in, t_out, p_d, instance) \
+            if condensed else build_nlp_control_related(sub_sys_type, t_in, t_out, p_d, instance)
+        # no state variables in single shooting
+        x_s_xs, x_s_lb, x_s_ub = ca.MX(0, 1), [], []
+        state_func = None
 
-    x_xx = ca.vertcat(x_τ_xτ, x_u_xu)
-    x_lb = x_τ_lb + x_u_lb
-    x_ub = x_τ_ub + x_u_ub
+    x_xx = ca.vertcat(x_τ_xτ, x_u_xu, x_s_xs)
+    x_lb = x_τ_lb + x_u_lb + x_s_lb
+    x_ub = x_τ_ub + x_u_ub + x_s_ub
     g_gx = ca.vertcat(g_τ_gτ, g_u_gu)
     g_lb = g_τ_lb + g_u_lb
     g_ub = g_τ_ub + g_u_ub
 
-    color_print(
-        'ok', 2,
-        'NLP struct for vehicle {} is built.'.format(v_index+1)
-    )
+    # parameters last, vehicle data after τ, λ and ρ
+    p_pp, param_fn = build_nlp_param_related(sub_sys_type, x_τ_xτ, t_in, t_c)
+    p_pp = ca.vertcat(p_pp, p_d)
+    goal_fn = cost_fn + param_fn
+
+    nlp = {'x': x_xx, 'p': p_pp, 'f': goal_fn, 'g': g_gx}
+    # compiled callbacks of IPOPT, if code generation is enabled
+    nlp_lib = compile_nlp(nlp, instance.codegen_cfgs)
+    # solver is cached in the template, only numerical values
+    # are passed to it on every ALADIN iteration
+    nlp_solver = ca.nlpsol(
+        'S_{}'.format(sub_sys_type.name), 'ipopt', nlp_lib or nlp, IPOPT_SETTING
+    ) if instance.solver_cache else None
+    # warm started solver starts from previous primal and dual iterates
+    nlp_warm_solver = ca.nlpsol(
+        'W_{}'.format(sub_sys_type.name), 'ipopt', nlp_lib or nlp, IPOPT_WARM_SETTING
+    ) if instance.solver_cache and instance.aladin_cfgs['WARM_START'] else None
+
+    color_print('ok', 2, 'NLP template for {} is built.', sub_sys_type.name)
 
     return {'x': x_xx, 'lbx': x_lb, 'ubx': x_ub,
             'xt': x_τ_xτ,
             'tin': t_in, 'tout': t_out, 'tc': t_c,
-            'xu': x_u_xu,
+            'xu': x_u_xu, 'xs': x_s_xs, 'xy': ca.vertcat(x_u_xu, x_s_xs),
+            'state_func': state_func,
             'g': g_gx, 'lbg': g_lb, 'ubg': g_ub,
             'gt': g_τ_gτ, 'gu': g_u_gu,
-            'cost': cost_fn, 'type': sub_sys_type}
+            'p': p_pp, 'pd': p_d,
+            'cost': cost_fn, 'f': goal_fn, 'type': sub_sys_type,
+            'nlp': nlp, 'nlp_lib': nlp_lib, 'codegen': instance.codegen_cfgs,
+            'solver': nlp_solver, 'warm_solver': nlp_warm_solver,
+            'cost_func': ca.Function('cost_{}'.format(sub_sys_type.name), [x_xx, p_d], [cost_fn, g_gx], ['x', 'd'], ['cost', 'g']),
+            # built on first use, see `helper.exact_derivative` and `helper.quasi_newton`
+            'derivative_func': None, 'derivative_map': dict(), 'gradient_func': None}
+
+def get_nlp_template(sub_sys_type, condensed, instance, templates=None):
+    templates = _nlp_templates if templates is None else templates
+    template_key = get_template_key(sub_sys_type, condensed, instance)
+    if template_key not in templates:
+        templates[template_key] = build_nlp_template(sub_sys_type, condensed, instance)
+    return templates[template_key]
+
+
+def build_nlp_struct(v_index, condensed=None, instance=None, templates=None):
+    """build_nlp_struct
+    Given initial velocity and position,
+    build variables and constraint needed in solving NLP
+
+    The struct is the template of the subsystem type with the
+    bounds of u, λ_index and vehicle data (`vehicle_val`) of the
+    vehicle. The template itself is `shared`.
+
+    `condensed` overrides `formulation_cfgs['CONDENSED']`,
+    which only applies to single shooting.
+    `instance` is the instance of the CWD if not given.
+    `templates` keeps the templates instead of the per-process cache.
+    """
+    if instance is None:
+        instance = get_instance()
+    if condensed is None:
+        condensed = instance.formulation_cfgs['CONDENSED']
+
+    sub_known = instance.v_inits[v_index]
+    sub_sys_type = get_sub_system_type(instance.sub_sys_count, v_index)
+    template = get_nlp_template(sub_sys_type, condensed, instance, templates)
+
+    n_τ, n_u = template['xt'].shape[0], template['xu'].shape[0]
+    x_lb, x_ub = list(template['lbx']), list(template['ubx'])
+    x_lb[n_τ:n_τ+n_u] = [sub_known['Umin']]*n_u
+    x_ub[n_τ:n_τ+n_u] = [sub_known['Umax']]*n_u
+
+    return {**template,
+            'lbx': x_lb, 'ubx': x_ub,
+            'λ_index': get_λ_index(v_index, sub_sys_type),
+            'vehicle_val': np.array([sub_known[name] for name in VEHICLE_PARAM_NAMES], dtype=float),
+            'shared': template}
+
+
+def build_full_constraint(nlp_struct):
+    """build_full_constraint
+    gu (Din, Dout and dynamics) followed by every control,
+    rows of active control bounds are selected from it
+    """
+    return ca.vertcat(nlp_struct['gu'], nlp_struct['xu'])
@@ -0,0 +1,86 @@
+"""
+===============
+Coupling Helper
+===============
+
+This module describes how τ of all subsystems are
+stacked into one vector, and builds the sparse
+coupling matrix of the consensus QP for a chain of
+any number of vehicles.
+
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+from helper.subsystype import SubSystemType, get_sub_system_type
+
+def get_τ_size(sub_sys_type: SubSystemType) -> int:
+    """`function` get_τ_size
+    ------------------------
+    head / body: Tin, Tout, Tc
+    tail / single: Tin, Tout
+    """
+    return 3 if sub_sys_type in (SubSystemType.head, SubSystemType.body) else 2
+
+def resize_τ(τ: np.ndarray, sub_sys_type: SubSystemType) -> np.ndarray:
+    """`function` resize_τ
+    ----------------------
+    τ of a subsystem whose type has changed, Tc is
+    initialized as Tout or dropped.
+    """
+    τ_size = get_τ_size(sub_sys_type)
+    return np.concatenate((τ, [τ[1]]*(τ_size-len(τ))))[:τ_size]
+
+def get_τ_offsets(sub_sys_count: int) -> np.ndarray:
+    """`function` get_τ_offsets
+    ---------------------------
+    Given `M`, return offsets of every τ in the stacked vector,
+    τ of subsystem `vi` is `[offsets[vi], offsets[vi+1])`.
+    """
+    τ_sizes = [
+        get_τ_size(get_sub_system_type(sub_sys_count, sub_index))
+        for sub_index in range(sub_sys_count)
+    ]
+    return np.concatenate(([0], np.cumsum(τ_sizes))).astype(int)
+
+def build_coupling_matrix(τ_offsets: np.ndarray, copy_active: np.ndarray) -> sp.csr_matrix:
+    """`function` build_coupling_matrix
+    -----------------------------------
+    First `M-1` rows: TiC - Ti+1In
+    Following rows:   TiOut - TiC, only for active copy constraints
+    """
+    sub_sys_count = len(τ_offsets) - 1
+    head_index = np.arange(sub_sys_count-1)
+    copy_index = head_index[copy_active]
+
+    t_in = τ_offsets[1:-1]
+    t_out = τ_offsets[:-2] + 1
+    t_c = τ_offsets[:-2] + 2
+
+    row_count = sub_sys_count - 1 + len(copy_index)
+    rows = np.concatenate((
+        head_index, head_index,
+        sub_sys_count - 1 + np.arange(len(copy_index)).repeat(2)
+    ))
+    cols = np.concatenate((
+        t_c, t_in,
+        np.column_stack((t_out[copy_index], t_c[copy_index])).reshape(-1)
+    ))
+    vals = np.concatenate((
+        np.ones(sub_sys_count-1), -np.ones(sub_sys_count-1),
+        np.tile([1., -1.], len(copy_index))
+    ))
+
+    return sp.csr_matrix((vals, (rows, cols)), shape=(row_count, τ_offsets[-1]))
+
+def get_coupling_violation(τ_offsets: np.ndarray, τ: np.ndarray) -> float:
+    """`function` get_coupling_violation
+    ------------------------------------
+    L1 violation of the coupling of stacked `τ`,
+    |TiC - Ti+1In| + max(0, TiOut - TiC)
+    """
+    t_in = τ[τ_offsets[1:-1]]
+    t_out = τ[τ_offsets[:-2]+1]
+    t_c = τ[τ_offsets[:-2]+2]
+    return np.sum(np.abs(t_c - t_in)) + np.sum(np.maximum(0, t_out - t_c))
@@ -19,3 +19,21 @@ def get_discretized_dynamics(len_t_s: ca.MX):
     )
     mat_dis_B = ca.vertcat(len_t_s**2/2, len_t_s)
     return mat_dis_A, mat_dis_B
+
+def get_condensed_dynamics(len_t_s, init_position, init_velocity, control):
+    """return positions and velocities after every sample in closed form
+
+    With constant interval length `h` and `k` = 1, ..., n
+
+        v_k = v0 + h Σ_{j<k} u_j
+        p_k = p0 + k h v0 + h² Σ_{j<k} (k-j-1/2) u_j
+
+    The Toeplitz sums are evaluated with prefix sums, which keeps
+    the expression linear in `n`.
+    """
+    n = control.shape[0]
+    sum_u = ca.cumsum(control)
+    velocity = init_velocity + len_t_s*sum_u
+    position = init_position + len_t_s*init_velocity*ca.DM(np.arange(1, n+1)) \
+        + len_t_s**2*(ca.cumsum(sum_u) - sum_u/2)
+    return position, velocity
@@ -1,62 +1,193 @@
-def exact_hessian(f, h, x, y, x_val, y_val,kappa_val):
+import warnings
 
-    # this function compute the gradient and hessian of g(x) defined as
-    # g(x) = min_y f(x,y) s.t. h(x,y) = 0 | kappa
-    # here, y^*(x) and kappa^*(x) can be consdiered as functions of x
+import numpy as np
+import casadi as ca
+from scipy.linalg import solve, lstsq, LinAlgError, LinAlgWarning
 
-    import numpy as np
-    import casadi as ca
+from problem import KKT_REGULARIZATION
+from helper.colorize import color_print
+from helper.constructor import build_full_constraint
+from helper.codegen import compile_function
+
+def build_derivative_function(f, h, x, y, p):
+    """fused function of all first and second order derivatives
+    The dual of h is an input, so the function only depends on
+    the structure of f and h.
+    """
+    kappa = ca.MX.sym('kappa', h.shape[0])
 
     # % define Lagrangian
-    L = f + ca.mtimes(ca.transpose(kappa_val), h)
-    
-    # % compute partial first order derivative
-    fx = ca.gradient(f, x)
-    eval_fx = ca.Function('fx', [x, y], [fx])
-    val_fx = eval_fx(x_val, y_val).full()
-
-    fy = ca.gradient(f, y)
-    eval_fy = ca.Function('fx', [x, y], [fy])
-    val_fy = eval_fy(x_val,y_val).full()
-
-    # % compute partial second order derivative
-    Lxx = ca.hessian(L, x)[0]
-    eval_Lxx = ca.Function('Lxx', [x, y], [Lxx])
-    val_Lxx = eval_Lxx(x_val,y_val)
-
-    Lyy = ca.hessian(L, y)[0]
-    eval_Lyy = ca.Function('Lyy', [x, y], [Lyy])
-    val_Lyy = eval_Lyy(x_val,y_val)
+    L = f + ca.dot(kappa, h)
 
     Lx = ca.gradient(L, x)
     Ly = ca.gradient(L, y)
 
-    Lyx = ca.jacobian(Ly, x)
-    eval_Lyx = ca.Function('Lyx', [x, y], [Lyx])
-    val_Lyx = eval_Lyx(x_val,y_val).full()
+    return ca.Function(
+        'derivatives',
+        [x, y, p, kappa],
+        [
+            # % partial first order derivative
+            ca.gradient(f, x), ca.gradient(f, y),
+            # % partial second order derivative
+            ca.hessian(L, x)[0], ca.hessian(L, y)[0],
+            ca.jacobian(Ly, x), ca.jacobian(Lx, y),
+            ca.jacobian(h, x), ca.jacobian(h, y),
+        ],
+        ['x', 'y', 'p', 'kappa'],
+        ['fx', 'fy', 'Lxx', 'Lyy', 'Lyx', 'Lxy', 'hx', 'hy']
+    )
+
+def get_derivative_function(nlp_struct):
+    """derivative function of a vehicle over the full constraint h
+    Control bounds are linear, so the Lagrangian is unchanged when
+    inactive rows have zero duals, and derivatives of the active set
+    are rows of the full ones. Built once per subsystem type, kept in
+    the shared NLP template and compiled if code generation is enabled.
+    """
+    template = nlp_struct['shared']
+    if template['derivative_func'] is None:
+        template['derivative_func'] = compile_function(build_derivative_function(
+            template['f'],
+            build_full_constraint(template),
+            template['xt'], template['xy'], template['p']
+        ), template['codegen'])
+    return template['derivative_func']
+
+def get_full_dual(eval_derivatives, active_rows, kappa_val):
+    """duals of the full h, zero for inactive rows
+    """
+    kappa_full = np.zeros(eval_derivatives.size1_in(3))
+    kappa_full[active_rows] = kappa_val
+    return kappa_full
+
+def get_derivative_map(nlp_struct, count, parallelization='serial', thread_count=1):
+    """derivative function of `count` vehicles sharing the template
+    of `nlp_struct`, inputs and outputs are stacked horizontally.
+    Outputs are dense, so that their nonzeros are all entries.
+    """
+    derivative_map = nlp_struct['shared']['derivative_map']
+    map_key = (count, parallelization, thread_count)
+    if map_key not in derivative_map:
+        eval_derivatives = get_derivative_function(nlp_struct)
+        eval_map = eval_derivatives.map(count, parallelization, thread_count) \
+            if parallelization == 'thread' else eval_derivatives.map(count, parallelization)
+        args = eval_map.mx_in()
+        derivative_map[map_key] = ca.Function(
+            '{}_{}'.format(eval_map.name(), count), args, [ca.densify(val) for val in eval_map(*args)]
+        )
+    return derivative_map[map_key]
+
+def eval_derivatives_batch(nlp_struct_list, x_list, y_list, p_list, kappa_full_list,
+                           parallelization='serial', thread_count=1):
+    """`fx, fy, Lxx, Lyy, Lyx, Lxy, hx, hy` of vehicles sharing one
+    template in one call, every output is stacked along the first
+    axis, e.g. `Lxx` has shape (vehicle count, n_x, n_x)
+    """
+    count = len(nlp_struct_list)
+    eval_derivatives = get_derivative_function(nlp_struct_list[0])
+    eval_map = get_derivative_map(nlp_struct_list[0], count, parallelization, thread_count)
+    val_list = eval_map(
+        np.column_stack(x_list), np.column_stack(y_list),
+        np.column_stack(p_list), np.column_stack(kappa_full_list)
+    )
+    # output i of vehicle j is column block j of the mapped output i,
+    # nonzeros are column-major, which is faster than `full`
+    return [
+        np.array(val.nonzeros()).reshape(count, eval_derivatives.size2_out(i), eval_derivatives.size1_out(i)).transpose(0, 2, 1)
+        for i, val in enumerate(val_list)
+    ]
+
+def eval_active_derivatives(nlp_struct, active_rows, x_val, y_val, p_val, kappa_val):
+    """`fx, fy, Lxx, Lyy, Lyx, Lxy, hx, hy` of the active constraints,
+    `kappa_val` are duals of `active_rows` of the full h
+    """
+    eval_derivatives = get_derivative_function(nlp_struct)
+    kappa_full = get_full_dual(eval_derivatives, active_rows, kappa_val)
+    val_fx, val_fy, val_Lxx, val_Lyy, val_Lyx, val_Lxy, val_hx, val_hy = (
+        val.full() for val in eval_derivatives(x_val, y_val, p_val, kappa_full)
+    )
+    return val_fx, val_fy, val_Lxx, val_Lyy, val_Lyx, val_Lxy, val_hx[active_rows], val_hy[active_rows]
+
+def solve_sensitivity(val_Lyy, val_Lyx, val_hx, val_hy):
+    """return dy/dx and dkappa/dx
+    Factorize the KKT matrix once (LDLᵀ) and solve for all columns
+
+        [ Lyy  hyᵀ ] [ dy/dx     ]     [ Lyx ]
+        [ hy   0   ] [ dkappa/dx ] = - [ hx  ]
 
-    Lxy = ca.jacobian(Lx, y)
-    eval_Lxy = ca.Function('Lxy', [x, y], [Lxy])
-    val_Lxy = eval_Lxy(x_val,y_val).full()
+    A regularized solve is only used if the matrix is singular.
+    """
+    n_y, n_h = val_Lyy.shape[0], val_hy.shape[0]
 
-    hx = ca.jacobian(h, x)
-    eval_hx = ca.Function('hx', [x, y], [hx])
-    val_hx = eval_hx(x_val,y_val).full()
+    kkt = np.block([
+        [val_Lyy, val_hy.T],
+        [val_hy, np.zeros((n_h, n_h))]
+    ])
+    rhs = -np.vstack((val_Lyx, val_hx))
 
-    hy = ca.jacobian(h, y)
-    eval_hy = ca.Function('hy', [x, y], [hy])
-    val_hy = eval_hy(x_val,y_val).full()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', LinAlgWarning)
+            sol = solve(kkt, rhs, assume_a='sym')
+    except (LinAlgError, LinAlgWarning):
+        color_print('warning', 2, 'KKT matrix is singular, regularizing')
+        kkt += np.diag(np.concatenate((
+            np.full(n_y, KKT_REGULARIZATION), np.full(n_h, -KKT_REGULARIZATION)
+        )))
+        sol = lstsq(kkt, rhs)[0]
 
+    return sol[:n_y], sol[n_y:]
+
+def exact_hessian(nlp_struct, active_rows, x_val, y_val, p_val, kappa_val):
+
+    # this function compute the gradient and hessian of g(x) defined as
+    # g(x) = min_y f(x,y) s.t. h(x,y) = 0 | kappa
+    # here, y^*(x) and kappa^*(x) can be consdiered as functions of x
+
+    return reduced_derivatives(*eval_active_derivatives(
+        nlp_struct, active_rows, x_val, y_val, p_val, kappa_val
+    ))
+
+def exact_hessian_batch(nlp_struct_list, active_rows_list, x_list, y_list, p_list, kappa_list,
+                        parallelization='serial', thread_count=1):
+    """`exact_hessian` of all vehicles, derivatives of vehicles sharing
+    a template are evaluated in one mapped call, returns `(H, g)`
+    of every vehicle in order
+    """
+    template_index = dict()
+    for sub_index, nlp_struct in enumerate(nlp_struct_list):
+        template_index.setdefault(id(nlp_struct['shared']), []).append(sub_index)
+
+    hessian_list = [None]*len(nlp_struct_list)
+    for sub_indices in template_index.values():
+        eval_derivatives = get_derivative_function(nlp_struct_list[sub_indices[0]])
+        val_stack = eval_derivatives_batch(
+            [nlp_struct_list[i] for i in sub_indices],
+            [x_list[i] for i in sub_indices], [y_list[i] for i in sub_indices],
+            [p_list[i] for i in sub_indices],
+            [get_full_dual(eval_derivatives, active_rows_list[i], kappa_list[i]) for i in sub_indices],
+            parallelization, thread_count
+        )
+        for batch_index, sub_index in enumerate(sub_indices):
+            val_fx, val_fy, val_Lxx, val_Lyy, val_Lyx, val_Lxy, val_hx, val_hy = (
+                val[batch_index] for val in val_stack
+            )
+            active_rows = active_rows_list[sub_index]
+            hessian_list[sub_index] = reduced_derivatives(
+                val_fx, val_fy, val_Lxx, val_Lyy, val_Lyx, val_Lxy, val_hx[active_rows], val_hy[active_rows]
+            )
+    return hessian_list
+
+def reduced_derivatives(val_fx, val_fy, val_Lxx, val_Lyy, val_Lyx, val_Lxy, val_hx, val_hy):
+    """gradient and Hessian of g(x) = min_y f(x,y) s.t. h(x,y) = 0
+    from partial derivatives at the solution
+    """
     # % comput dy/dx, dkppa/dx
-    val_Lyy_inv = np.linalg.pinv(val_Lyy.full())
-    dkdx = np.dot(np.linalg.pinv(val_hy @ val_Lyy_inv @ ca.transpose(val_hy)),(val_hx - val_hy @ val_Lyy_inv @ val_Lyx))
-    dydx = -val_Lyy_inv @ (ca.transpose(val_hy) @ dkdx + val_Lyx)
+    dydx, dkdx = solve_sensitivity(val_Lyy, val_Lyx, val_hx, val_hy)
 
-    # % gradient 
-    g = val_fx + ca.transpose(dydx) @ val_fy
+    # % gradient
+    g = val_fx + dydx.T @ val_fy
     # % Hessian
-    H = val_Lxx.full() + val_Lxy @ dydx.full() - dydx.T @ val_hy.T @ dkdx 
-
-    H, g = H.full(), g.full()
+    H = val_Lxx + val_Lxy @ dydx - dydx.T @ val_hy.T @ dkdx
 
     return H, g
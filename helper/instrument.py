@@ -0,0 +1,102 @@
+"""
+===============
+Instrumentation
+===============
+
+Records wall time of every ALADIN step (and of every vehicle in
+STEP 1 unless it runs on a pool, and in STEP 3 unless it is
+batched), solver statistics and the residual of STEP 2, one flat
+record per iteration, so that records can be exported as JSON
+lines or CSV. IPOPT wall times of every vehicle are recorded in
+both modes.
+
+When disabled, every method returns immediately.
+
+"""
+
+import csv
+import json
+import time
+from contextlib import contextmanager
+
+from problem import get_instance
+
+class Instrument:
+    """`class` Instrument
+    ---------------------
+    with instrument.timer('step_3', sub_index):
+        ...
+    instrument.record(residual=...)
+    instrument.end_iter()
+    """
+    def __init__(self, instance=None, enabled=None):
+        instrument_cfgs = (get_instance() if instance is None else instance).instrument_cfgs
+        self.enabled = instrument_cfgs['ENABLED'] if enabled is None else enabled
+        self.path = instrument_cfgs['PATH']
+        self.records = []
+        self.current = dict()
+
+    @contextmanager
+    def timer(self, step, sub_index=None):
+        """wall time of `step`, key is `t_{step}` or `t_{step}_v{sub_index+1}`
+        """
+        if not self.enabled:
+            yield
+            return
+        time_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = 't_{}'.format(step) if sub_index is None else 't_{}_v{}'.format(step, sub_index+1)
+            self.current[key] = time.perf_counter() - time_start
+
+    def record(self, **fields):
+        if self.enabled:
+            self.current.update(fields)
+
+    def record_ipopt(self, opt_soln_list):
+        """IPOPT statistics returned by STEP 1 of every vehicle
+        """
+        if not self.enabled:
+            return
+        for sub_index, opt_soln in enumerate(opt_soln_list):
+            for key, val in opt_soln['ipopt_stats'].items():
+                self.current['ipopt_{}_v{}'.format(key, sub_index+1)] = val
+
+    def record_qp(self, qp_stats):
+        """qpOASES statistics, `iter_count` counts working set changes
+        """
+        if not self.enabled or qp_stats is None:
+            return
+        self.current['qp_working_set_changes'] = qp_stats['iter_count']
+        self.current['qp_return_status'] = qp_stats['return_status']
+        self.current['qp_t_wall'] = qp_stats['t_wall_solver']
+
+    def end_iter(self, iter_count):
+        if not self.enabled:
+            return
+        self.records.append({'iter': iter_count, **{
+            key: val.item() if hasattr(val, 'item') else val
+            for key, val in self.current.items()
+        }})
+        self.current = dict()
+
+    def export(self, path=None):
+        """write all records, CSV if `path` ends with `.csv`, JSON lines otherwise,
+        `path` defaults to `debug.instrument.path` relative to the base directory
+        """
+        if not self.enabled:
+            return
+        path = self.path if path is None else path
+
+        if path.endswith('.csv'):
+            # later iterations may have fields the first one doesn't have
+            fieldnames = list(dict.fromkeys(key for rec in self.records for key in rec))
+            with open(path, 'w', newline='') as csv_file:
+                writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(self.records)
+        else:
+            with open(path, 'w') as jsonl_file:
+                for rec in self.records:
+                    jsonl_file.write(json.dumps(rec, ensure_ascii=False) + '\n')
@@ -0,0 +1,161 @@
+"""
+===================
+Quasi-Newton Helper
+===================
+
+Hessians of the consensus QP approximated by a damped BFGS
+update per vehicle, instead of exact second order sensitivities.
+
+Only the Hessian of the cost (with the constraints of the
+subproblem eliminated) is approximated. The augmented term
+ρ/2|τ - z|² + λᵀAτ of the subproblem changes with z and λ on
+every iteration, its Hessian ρI is added exactly.
+
+By the envelope theorem, the gradient of the reduced cost is
+the gradient of the Lagrangian with respect to τ, so that only
+first order derivatives are evaluated.
+
+"""
+
+import numpy as np
+import casadi as ca
+
+from helper.constructor import build_full_constraint
+from helper.codegen import compile_function
+
+def build_gradient_function(f, cost, h, x, y, p):
+    """gradients of the Lagrangian of the subproblem and of the cost
+    with respect to x, the dual of h is an input
+    """
+    kappa = ca.MX.sym('kappa', h.shape[0])
+    return ca.Function(
+        'gradients',
+        [x, y, p, kappa],
+        [ca.gradient(f + ca.dot(kappa, h), x), ca.gradient(cost + ca.dot(kappa, h), x)],
+        ['x', 'y', 'p', 'kappa'],
+        ['Lx', 'cost_Lx']
+    )
+
+def get_gradient_function(nlp_struct):
+    """gradient function of a subsystem type, kept in the shared
+    NLP template like the derivative function of STEP 3
+    """
+    template = nlp_struct['shared']
+    if template['gradient_func'] is None:
+        template['gradient_func'] = compile_function(build_gradient_function(
+            template['f'], template['cost'],
+            build_full_constraint(template),
+            template['xt'], template['xy'], template['p']
+        ), template['codegen'])
+    return template['gradient_func']
+
+def eval_gradients(nlp_struct, active_rows, x_val, y_val, p_val, kappa_val):
+    """gradient of the subproblem and of the reduced cost at the
+    solution, `kappa_val` are duals of `active_rows` of the full h
+    """
+    eval_gradient = get_gradient_function(nlp_struct)
+    kappa_full = np.zeros(eval_gradient.size1_in(3))
+    kappa_full[active_rows] = kappa_val
+    val_Lx, val_cost_Lx = eval_gradient(x_val, y_val, p_val, kappa_full)
+    return val_Lx.full(), val_cost_Lx.full()
+
+def damped_bfgs_update(B, s, y, damping=0.2):
+    """`function` damped_bfgs_update
+    --------------------------------
+    Powell's damped BFGS update of `B` from the step `s` and
+    the gradient change `y`. `y` is blended with `Bs` if the
+    curvature sᵀy is below `damping` sᵀBs, which keeps `B`
+    positive definite. Returns `None` if the update fails.
+    """
+    Bs = B @ s
+    sBs = s @ Bs
+    sy = s @ y
+    if not sBs > 0:
+        return None
+    θ = 1. if sy >= damping*sBs else (1.-damping)*sBs / (sBs-sy)
+    r = θ*y + (1.-θ)*Bs
+    sr = s @ r
+    if not sr > 0:
+        return None
+    B_next = B - np.outer(Bs, Bs)/sBs + np.outer(r, r)/sr
+    if not np.all(np.isfinite(B_next)):
+        return None
+    return B_next
+
+class BlockBFGS:
+    """`class` BlockBFGS
+    --------------------
+    Approximated Hessians of the reduced cost of every vehicle,
+    initialized from `aladin.para.H`, which is scaled to the
+    curvature of the first step. Vehicles whose update fails,
+    or whose τ size changed, are reset to their exact Hessian.
+    """
+    def __init__(self, H_init=None, step_tol=1e-10, eig_min=1e-6):
+        self.H_init = [np.asarray(H_i, dtype=float) for H_i in (H_init or [])]
+        self.step_tol = step_tol
+        self.eig_min = eig_min
+        self.B = dict()
+        self.prev = dict()
+        self.scaled = set()
+        self.update_count = 0
+        self.skip_count = 0
+        self.fallback_count = 0
+
+    def get_initial(self, sub_index, τ_size) -> np.ndarray:
+        """configured H of the vehicle (the last one for any further
+        vehicle), extended by identity if it is smaller than τ
+        """
+        B = np.eye(τ_size)
+        if self.H_init:
+            H_i = self.H_init[min(sub_index, len(self.H_init)-1)]
+            size = min(τ_size, len(H_i))
+            B[:size,:size] = H_i[:size,:size]
+        return B
+
+    def update(self, sub_index, τ, cost_gradient):
+        """`method` update
+        ------------------
+        Approximated Hessian of vehicle `sub_index` at `τ`, `None`
+        if it is not available and the exact one is needed.
+        """
+        τ, cost_gradient = np.ravel(τ), np.ravel(cost_gradient)
+        B, prev = self.B.get(sub_index), self.prev.get(sub_index)
+        self.prev[sub_index] = (τ, cost_gradient)
+
+        if B is None or len(B) != len(τ):
+            if sub_index in self.B:
+                return None
+            B = self.get_initial(sub_index, len(τ))
+        elif prev is not None and len(prev[0]) == len(τ):
+            s, y = τ - prev[0], cost_gradient - prev[1]
+            if np.linalg.norm(s) <= self.step_tol:
+                self.skip_count += 1
+            else:
+                if sub_index not in self.scaled and s @ y > 0:
+                    # Rayleigh quotient of B along s becomes yᵀy / sᵀy
+                    B = B * (y @ y) / (s @ y) * (s @ s) / (s @ B @ s)
+                self.scaled.add(sub_index)
+                B = damped_bfgs_update(B, s, y)
+                if B is None:
+                    return None
+                self.update_count += 1
+        self.B[sub_index] = B
+        return B
+
+    def reset(self, sub_index, B):
+        """continue updates of vehicle `sub_index` from `B`, after its
+        exact Hessian was used, with eigenvalues lifted to keep it
+        positive definite
+        """
+        self.fallback_count += 1
+        self.scaled.add(sub_index)
+        eig_val, eig_vec = np.linalg.eigh((B + B.T)/2)
+        eig_val = np.maximum(eig_val, self.eig_min*max(1., np.abs(eig_val).max()))
+        self.B[sub_index] = (eig_vec * eig_val) @ eig_vec.T
+
+    def stats(self) -> dict:
+        return {
+            'update_count': self.update_count,
+            'skip_count': self.skip_count,
+            'fallback_count': self.fallback_count,
+        }
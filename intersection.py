@@ -22,50 +22,66 @@ Throughout the solution, we have 2 different combination of optimization variabl
 
 However, different cars have different initial velocity.
 """
-from pprint import pprint
+import time
+import multiprocessing as mp
+from contextlib import contextmanager
 
 import numpy as np
-import casadi as ca
 
-from problem import ALADIN_CFGS, SUB_SYS_COUNT, SAMPLE_N1, SAMPLE_N2, CONFIGS, SYMBOL_DEBUG
+from problem import SYMBOL_DEBUG, get_instance
 from helper import constructor
-from helper.subsystype import SubSystemType, get_sub_system_type
-from helper.colorize import color_print
-from aladin.step_1_solve_nlp import step_1_solve_nlp
-from aladin.step_2_term_cond import step_2_term_cond
-from aladin.step_3_derivatives import step_3_derivatives
-from aladin.step_4_solve_qp import step_4_solve_qp
+from helper.colorize import color_print, configure_log, flush_log
+from helper.coupling import get_τ_offsets, get_coupling_violation
+from helper.centralized_reference import get_initial_guess
+from helper.instrument import Instrument
+from helper.quasi_newton import BlockBFGS
+from aladin.step_1_solve_nlp import step_1_solve_nlp, step_1_solve_nlp_pool, get_warm_start
+from aladin.step_2_term_cond import step_2_term_cond, get_residual, update_ρ
+from aladin.step_3_derivatives import step_3_derivatives, step_3_derivatives_batch, step_3_derivatives_bfgs
+from aladin.step_4_solve_qp import step_4_solve_qp, ConsensusQP
+from aladin.step_5_line_search import step_5_line_search, get_local_controls
 
 def welcome():
-    print('==========================')
-    print('ALADIN Intersection Solver')
-    print('==========================')
+    color_print('ok', 0, '==========================')
+    color_print('ok', 0, 'ALADIN Intersection Solver')
+    color_print('ok', 0, '==========================')
 
 
-def main():
+def main(instance=None):
     """
+    Solve `instance`, the problem of the CWD by default.
+    Returns the summary of `solve`.
+
     Optimization Structurization
     ----------------------------
     To save time, we don't construct variables and
     constraint on every loop. Instead, we construct
     them before the first iteration.
     """
+    if instance is None:
+        instance = get_instance()
+    instance.validate()
+    configure_log(instance)
+
+    sub_sys_count = instance.sub_sys_count
+
     welcome()
     
     """
         NLP Structurization
     """
-    nlp_struct = [constructor.build_nlp_struct(sub_index) for sub_index in range(SUB_SYS_COUNT)]
+    nlp_struct = [constructor.build_nlp_struct(sub_index, instance=instance) for sub_index in range(sub_sys_count)]
 
     """
         QP Structurization
         *: only required when using IPOPT to solve QP.
     """
-    # qp_struct = constructor.build_qp_struct(SUB_SYS_COUNT)
+    # qp_struct = constructor.build_qp_struct(sub_sys_count)
+    consensus_qp = ConsensusQP()
 
     """
-    τ, u, λ should have initial value before first iteration
-    TODO replace fixed value `helper.centralized_reference`
+    τ, u, λ should have initial value before first iteration,
+    see `helper.centralized_reference`
     """
     # @param var_τ
     #   size (3, 1) or (2, 1)
@@ -73,126 +89,266 @@ def main():
     #   * head: Tin, Tout, Tc
     #   * body: Tin, Tout, Tc
     #   * tail: Tin, Tout
-    var_τ = [
-        np.array([7.25105129939717, 7.33483311739565, 7.33483310753611]),
-        np.array([7.33483310753611, 7.97749052696764, 7.97749051709728]),
-        np.array([8.3749051709728, 8.98871120516430, 8.99871119535654]),
-        np.array([12.3371119535654, 10.69449434539719]),
-    ]
-
     # @param var_u
     #   size (SAMPLE_N1 + SAMPLE_N2, 1)
     # Sub-system optimization variable
-    var_u = [
-        np.array([1.622531378, 1.532418169, 1.388678581, 1.127354991, 0.546333175, -0.427024026, -1.051964747, -1.350808261, -0.515754497, -0.548483267, -2.92e-09]),
-        np.array([0.440943499, 0.371596761, 0.300548885, 0.228051776, 0.15443599, 0.080098682, 0.005480858, -0.068963037, -0.039347146, -0.083367171, -6.25e-10]),
-        np.array([-0.861005866, -0.666381045, -0.425623341, -0.150389793, 0.138192487, 0.414192525, 0.656296234, 0.852753533, 0.157146887, 0.120843793, 4.74e-10]),
-        np.array([-1.726596536, -1.643441148, -1.49094536, -1.130687198, 0.140486844, 1.167191186, 1.507653314, 1.652923525, 0.750888127, 0.747020972, 4.88e-09]),
-    ]
-
     # @param var_λ
-    #   size (SUB_SYS_COUNT - 1, 1)
+    #   size (sub_sys_count - 1, 1)
     # Dual variable of coupling constraints
-    if SYMBOL_DEBUG:
-        # var_λ = np.array([17.8768591674695,19.3575077012303,13.0531045254504])
-        var_λ = np.array([1,1,1])
-    else:
-        var_λ = -1*np.array([17.8768591674695,19.3575077012303,13.0531045254504])
+    var_τ, var_u, var_λ = get_initial_guess(instance)
+
+    with worker_pool(instance) as pool:
+        return solve(instance, nlp_struct, var_τ, var_u, var_λ, consensus_qp, pool=pool)
+
+
+@contextmanager
+def worker_pool(instance):
+    """
+    Worker pool for STEP 1 if `performance.parallel` is set, `None`
+    otherwise. Workers keep their NLP structs and solvers between
+    solves, so callers solving repeatedly create the pool once and
+    pass it to every `solve`.
+    """
+    if not instance.parallel:
+        yield None
+        return
+    with mp.Pool(instance.pool_cnt) as pool:
+        yield pool
 
-    param_ρ = CONFIGS['aladin']['para']['ρ']
+
+def solve(instance, nlp_struct, var_τ, var_u, var_λ, consensus_qp=None, time_budget=None, pool=None):
+    """
+    ALADIN iterations from the given τ, u and λ, with NLP structs
+    (and consensus QP solvers) built beforehand, so that they can
+    be kept between solves. Lists passed in are not modified.
+    STEP 1 runs on `pool` if given, see `worker_pool`, and
+    sequentially otherwise.
+
+    With `time_budget` (seconds), iterations stop as soon as the next
+    one is not expected to finish in time, and the last iterate whose
+    coupling violation is within `TOL` is returned. That is a STEP 1
+    solution, or τ after STEP 6 with the controls of `get_local_controls`.
+    If there is none yet, the STEP 1 solution of smallest residual is
+    returned with `feasible` false, it must not be applied.
+
+    Returns a summary of the solve, `τ` and `u` of the last (or
+    returned) iterate, `λ`, whether that iterate satisfies the
+    coupling (`feasible`), and the instrumentation records if enabled.
+    """
+    time_start = time.perf_counter()
+    sub_sys_count, aladin_cfgs = len(nlp_struct), instance.aladin_cfgs
+    var_τ, var_u = list(var_τ), list(var_u)
+    if consensus_qp is None:
+        consensus_qp = ConsensusQP()
+
+    param_ρ = instance.param_ρ
+    adaptive_ρ_cfgs = instance.adaptive_ρ_cfgs
+    prev_residual = None
+    if adaptive_ρ_cfgs['ENABLED']:
+        param_ρ = min(max(param_ρ, adaptive_ρ_cfgs['MIN']), adaptive_ρ_cfgs['MAX'])
+
+    τ_offsets = get_τ_offsets(sub_sys_count)
+
+    def get_violation(τ_list):
+        return get_coupling_violation(τ_offsets, np.concatenate(τ_list))
+
+    def get_plan(τ_list, u_list, λ):
+        return {'τ': list(τ_list), 'u': list(u_list), 'λ': λ, 'violation': get_violation(τ_list)}
+
+    instrument = Instrument(instance)
+
+    # approximated Hessians of STEP 3, kept between iterations
+    block_bfgs = BlockBFGS(instance.param_H) if aladin_cfgs['HESSIAN'] == 'bfgs' else None
 
     """
     Begin of Loop
     """
-    opt_sol, nlp_goal_func = [None]*SUB_SYS_COUNT, [None]*SUB_SYS_COUNT
-    qp_gradient, qp_hessian = [None]*SUB_SYS_COUNT, [None]*SUB_SYS_COUNT
+    opt_sol = [None]*sub_sys_count
+    ipopt_iter_total = 0
+    qp_gradient, qp_hessian = [None]*sub_sys_count, [None]*sub_sys_count
+    # STEP 1 solutions are locally feasible, keep the one closest to consensus
+    best_residual, best_sol, best_λ = np.inf, None, None
+    # last coupling-feasible iterate, returned at the deadline
+    feasible_plan = None
+    deadline_hit = False
 
-    for iter_count in range(ALADIN_CFGS['MAX_ITER']):
+    for iter_count in range(aladin_cfgs['MAX_ITER']):
+        time_iter = time.perf_counter()
 
         """
         STEP 1 Solve decoupled NLP
         """
-        for sub_index in range(SUB_SYS_COUNT):
-            sub_sys_type = get_sub_system_type(SUB_SYS_COUNT, sub_index)
-            opt_sol[sub_index], nlp_goal_func[sub_index] = step_1_solve_nlp(
-                nlp_struct=nlp_struct[sub_index],
-                sub_index=sub_index,
-                var_u=var_u[sub_index],
-                var_τ=var_τ[sub_index],
-                var_λ=var_λ,
-                param_ρ=param_ρ
-            )
-        color_print('ok', 1, 'iter {} nlp'.format(iter_count))
+        with instrument.timer('step_1'):
+            if pool is not None:
+                opt_sol = step_1_solve_nlp_pool(
+                    pool=pool,
+                    nlp_struct=nlp_struct,
+                    var_u=var_u,
+                    var_τ=var_τ,
+                    var_λ=var_λ,
+                    param_ρ=param_ρ,
+                    warm_start=[get_warm_start(opt_soln, instance) for opt_soln in opt_sol],
+                    instance=instance
+                )
+            else:
+                for sub_index in range(sub_sys_count):
+                    with instrument.timer('step_1', sub_index):
+                        opt_sol[sub_index] = step_1_solve_nlp(
+                            nlp_struct=nlp_struct[sub_index],
+                            sub_index=sub_index,
+                            var_u=var_u[sub_index],
+                            var_τ=var_τ[sub_index],
+                            var_λ=var_λ,
+                            param_ρ=param_ρ,
+                            warm_start=get_warm_start(opt_sol[sub_index], instance),
+                            active_tol=aladin_cfgs['ACTIVE_TOL']
+                        )
+        ipopt_iter = [opt_soln['ipopt_iter'] for opt_soln in opt_sol]
+        ipopt_iter_total += sum(ipopt_iter)
+        color_print('ok', 1, 'iter {} nlp', iter_count)
+        color_print('info', 1, 'iter {iter_count} ipopt iterations {ipopt_iter}', iter_count=iter_count, ipopt_iter=ipopt_iter)
+        instrument.record_ipopt(opt_sol)
 
         """
         STEP 2 Form Ai for QP and check termination condition
         """
-        should_terminate, qp_a, qp_b = step_2_term_cond(opt_sol)
+        with instrument.timer('step_2'):
+            should_terminate, qp_a, qp_b, residual = step_2_term_cond(opt_sol, instance)
+        instrument.record(rho=param_ρ, residual=get_residual(residual), **{
+            'residual_{}'.format(key): val for key, val in residual.items()
+        })
+        if get_residual(residual) < best_residual:
+            best_residual, best_sol, best_λ = get_residual(residual), list(opt_sol), var_λ
+        if time_budget is not None:
+            plan = get_plan([opt_soln['τ'] for opt_soln in opt_sol], [opt_soln['u'] for opt_soln in opt_sol], var_λ)
+            if plan['violation'] <= aladin_cfgs['TOL']:
+                feasible_plan = plan
         if should_terminate:
-            color_print('ok', 0, 'Tolerance of {} is satisfied. Problem is optimized.'.format(ALADIN_CFGS['TOL']))
+            instrument.end_iter(iter_count)
+            color_print('ok', 0, 'Tolerance of {} is satisfied. Problem is optimized.', aladin_cfgs['TOL'])
             # TODO plot()
             break
+        # assume the next iteration takes as long as this one
+        if time_budget is not None and 2*time.perf_counter()-time_iter-time_start > time_budget:
+            instrument.end_iter(iter_count)
+            color_print('warning', 0, 'Time budget of {:.3f} s is used up, returning the best iterate.', time_budget)
+            deadline_hit = True
+            break
 
         """
         STEP 3 Find gradient and Hessian matrix
         """
-        for sub_index in range(SUB_SYS_COUNT):
-            qp_gradient[sub_index], qp_hessian[sub_index] = step_3_derivatives(nlp_struct[sub_index], nlp_goal_func[sub_index], opt_sol[sub_index])
-        color_print('ok', 1, 'iter {} find gradient and hessian'.format(iter_count))
+        with instrument.timer('step_3'):
+            if block_bfgs is not None:
+                qp_gradient, qp_hessian = step_3_derivatives_bfgs(nlp_struct, opt_sol, block_bfgs, param_ρ)
+            elif instance.derivative_map != 'none':
+                qp_gradient, qp_hessian = step_3_derivatives_batch(
+                    nlp_struct, opt_sol, instance.derivative_map, instance.pool_cnt
+                )
+            else:
+                for sub_index in range(sub_sys_count):
+                    with instrument.timer('step_3', sub_index):
+                        qp_gradient[sub_index], qp_hessian[sub_index] = step_3_derivatives(nlp_struct[sub_index], opt_sol[sub_index])
+        color_print('ok', 1, 'iter {} find gradient and hessian', iter_count)
 
         """
         STEP 4 Solve coupled concensus QP
         """
-        opt_Δτ, opt_qp_λ = step_4_solve_qp(qp_gradient, qp_hessian, qp_a, qp_b)
-        color_print('ok', 1, 'iter {} con qp'.format(iter_count))
+        with instrument.timer('step_4'):
+            opt_Δτ, opt_qp_λ = step_4_solve_qp(
+                qp_hessian, qp_gradient, qp_a, qp_b, consensus_qp, aladin_cfgs['QP_SOLVER']
+            )
+        instrument.record_qp(consensus_qp.last_stats)
+        color_print('ok', 1, 'iter {} con qp', iter_count)
 
         """
-        TODO STEP 5 Do line search 
+        STEP 5 Do line search
         """
+        with instrument.timer('step_5'):
+            step_α = step_5_line_search(nlp_struct, τ_offsets, opt_sol, opt_Δτ, instance)
+        instrument.record(alpha=step_α)
 
         """
         STEP 6 Update variables
         """
-        for sub_index in range(SUB_SYS_COUNT-1):
-            # Update τ
-            color_print('debug', 2, 'updating value for car {}'.format(sub_index+1))
-            color_print('debug', 3, '[{}] τ prev'.format(sub_index+1))
-            pprint(var_τ[sub_index])
-            color_print('debug', 3, '[{}] τ updated'.format(sub_index+1))
-            pprint(opt_sol[sub_index]['τ'] + opt_Δτ[sub_index*3:(sub_index+1)*3,0])
-
-            var_τ[sub_index] = opt_sol[sub_index]['τ'] + opt_Δτ[sub_index*3:(sub_index+1)*3,0]
-
-            # Update u
-            color_print('debug', 3, '[{}] u prev'.format(sub_index+1))
-            pprint(var_u[sub_index])
-            color_print('debug', 3, '[{}] u updated'.format(sub_index+1))
-            pprint(opt_sol[sub_index]['u'])
-
-            var_u[sub_index] = opt_sol[sub_index]['u']
-        # Update for the last
-        color_print('debug', 2, 'updating value for last car')
-        color_print('debug', 3, '[last] τ prev')
-        pprint(var_τ[-1])
-        color_print('debug', 3, '[last] τ updated')
-        pprint(opt_sol[-1]['τ'] + opt_Δτ[-2:,0])
-
-        var_τ[-1] = opt_sol[-1]['τ'] + opt_Δτ[-2:,0]
-        var_u[-1] = opt_sol[-1]['u']
-
-        # Update λ
-        color_print('debug', 2, 'updating λ')
-        pprint(opt_qp_λ[-3:])
-
-        var_λ = opt_qp_λ[-3:]
+        with instrument.timer('step_6'):
+            for sub_index in range(sub_sys_count):
+                # Update τ
+                color_print('debug', 2, 'updating value for car {}', sub_index+1)
+                color_print('debug', 3, '[{}] τ prev\n{!r}', sub_index+1, var_τ[sub_index])
+                var_τ[sub_index] = opt_sol[sub_index]['τ'] + step_α*opt_Δτ[τ_offsets[sub_index]:τ_offsets[sub_index+1],0]
+                color_print('debug', 3, '[{}] τ updated\n{!r}', sub_index+1, var_τ[sub_index])
+
+                # Update u
+                color_print('debug', 3, '[{}] u prev\n{!r}', sub_index+1, var_u[sub_index])
+                var_u[sub_index] = opt_sol[sub_index]['u']
+                color_print('debug', 3, '[{}] u updated\n{!r}', sub_index+1, var_u[sub_index])
+
+            # Update λ
+            # duals of the first `sub_sys_count-1` rows of A (TiC - Ti+1In) are
+            # the increments of λ, since gradients of STEP 3 already contain λ
+            color_print('debug', 2, 'updating λ\n{!r}', opt_qp_λ[:sub_sys_count-1])
+
+            var_λ = var_λ + step_α*(1 if SYMBOL_DEBUG else -1)*opt_qp_λ[:sub_sys_count-1,0]
+
+            # controls of the updated τ are only recovered if it is feasible
+            if time_budget is not None and get_violation(var_τ) <= aladin_cfgs['TOL']:
+                local_y = [
+                    get_local_controls(nlp_struct[sub_index], opt_sol[sub_index], var_τ[sub_index])
+                    for sub_index in range(sub_sys_count)
+                ]
+                feasible_plan = get_plan(var_τ, [
+                    y[:len(opt_soln['u'])] for y, opt_soln in zip(local_y, opt_sol)
+                ], var_λ)
+
+        # ρ of the next STEP 1, STEP 3 to 5 of this iteration used the current one
+        param_ρ = update_ρ(param_ρ, residual, adaptive_ρ_cfgs, prev_residual)
+        prev_residual = residual
 
         color_print('ok', 0, '-----------------------')
-        color_print('ok', 0, 'ITER {} COMPLETED'.format(iter_count))
-        print('\n\n\n\n')
-    
+        color_print('ok', 0, 'ITER {} COMPLETED', iter_count)
+        instrument.end_iter(iter_count)
+
+    color_print('info', 1, 'IPOPT iterations in total {}', ipopt_iter_total)
+    color_print('info', 1, 'QP solver reused {hit_count}/{solve_count} times', **consensus_qp.stats())
+    hessian_stats = {'mode': aladin_cfgs['HESSIAN'], **(block_bfgs.stats() if block_bfgs is not None else dict())}
+    color_print(
+        'info', 1, '{mode} Hessians: {iter_count} iterations, {time_per_iter:.3f} s per iteration',
+        iter_count=iter_count+1, time_per_iter=(time.perf_counter()-time_start)/(iter_count+1), **hessian_stats
+    )
+
+    instrument.export()
+
     # max iteration warning
-    if iter_count+1 == ALADIN_CFGS['MAX_ITER']:
+    if iter_count+1 == aladin_cfgs['MAX_ITER']:
         color_print('warning', 0, 'max iteration reached, tolerance isn\'t met.')
+    flush_log()
+
+    plan = get_plan([opt_soln['τ'] for opt_soln in opt_sol], [opt_soln['u'] for opt_soln in opt_sol], var_λ)
+    final_residual = get_residual(residual)
+    if deadline_hit and feasible_plan is not None:
+        plan, final_residual = feasible_plan, feasible_plan['violation']
+    elif deadline_hit:
+        plan = get_plan([opt_soln['τ'] for opt_soln in best_sol], [opt_soln['u'] for opt_soln in best_sol], best_λ)
+        final_residual = best_residual
+        color_print('warning', 0, 'No coupling-feasible iterate before the deadline, the plan is infeasible.')
+
+    return {
+        'converged': bool(should_terminate),
+        'feasible': bool(plan['violation'] <= aladin_cfgs['TOL']),
+        'deadline_hit': deadline_hit,
+        'iter_count': iter_count+1,
+        'time': time.perf_counter()-time_start,
+        'residual': float(final_residual),
+        'ipopt_iter': ipopt_iter_total,
+        'qp': consensus_qp.stats(),
+        'hessian': hessian_stats,
+        'τ': [np.asarray(τ, dtype=float).tolist() for τ in plan['τ']],
+        'u': [np.asarray(u, dtype=float).tolist() for u in plan['u']],
+        'λ': np.asarray(plan['λ'], dtype=float).tolist(),
+        'ρ': param_ρ,
+        'records': instrument.records,
+    }
 
 if __name__ == '__main__':
     main()
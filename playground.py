@@ -1 +1,43 @@
+"""
+Compare the recursive MX dynamics with the condensed SX dynamics
+by building every NLP struct and solving STEP 1 once per vehicle.
+N1 and N2 are read from `config.json`.
+"""
+import time
 
+from problem import get_instance
+from helper import constructor
+from aladin.step_1_solve_nlp import step_1_solve_nlp
+
+import numpy as np
+
+def compare_dynamics(repeat=5):
+    instance = get_instance()
+    sub_sys_count = instance.sub_sys_count
+    print('N1={}, N2={}, {} vehicles'.format(instance.sample_n1, instance.sample_n2, sub_sys_count))
+    print('{:>10} {:>10} {:>10}'.format('dynamics', 'build [s]', 'solve [s]'))
+
+    for condensed in (False, True):
+        time_build = time.perf_counter()
+        nlp_struct = [constructor.build_nlp_struct(sub_index, condensed, instance) for sub_index in range(sub_sys_count)]
+        time_build = time.perf_counter() - time_build
+
+        time_solve = time.perf_counter()
+        for _ in range(repeat):
+            for sub_index in range(sub_sys_count):
+                n_τ = nlp_struct[sub_index]['xt'].shape[0]
+                step_1_solve_nlp(
+                    nlp_struct[sub_index], sub_index,
+                    var_u=np.zeros(instance.sample_n1+instance.sample_n2),
+                    var_τ=np.array([instance.t_guess[sub_index]['TinG']] + [instance.t_guess[sub_index]['ToutG']]*(n_τ-1)),
+                    var_λ=np.ones(sub_sys_count-1),
+                    param_ρ=1,
+                )
+        time_solve = (time.perf_counter() - time_solve) / repeat
+
+        print('{:>10} {:>10.4f} {:>10.4f}'.format(
+            'condensed' if condensed else 'recursive', time_build, time_solve
+        ))
+
+if __name__ == '__main__':
+    compare_dynamics()
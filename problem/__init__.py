@@ -1,10 +1,13 @@
 """
-Put configs into global variables.
+Solver settings, and the problem instance.
+
+Nothing is read on import. Data and configs of a problem
+are held by `ProblemInstance`; the former global variables
+(`CONFIGS`, `SUB_SYS_COUNT`, ...) are still available and
+are taken from the instance of the CWD on first access.
 """
 
-import multiprocessing as mp
-import numpy as np
-from helper.io import json2dict, csv2list
+from problem.instance import ProblemInstance, get_instance, kmph2mps
 
 IPOPT_SETTING = {
     'ipopt': {
@@ -15,37 +18,55 @@ IPOPT_SETTING = {
     'print_time': 0,
 }
 
+# Used when ALADIN_CFGS['WARM_START'] is enabled,
+# primal and dual iterates are close to the solution
+IPOPT_WARM_SETTING = {
+    'ipopt': {
+        **IPOPT_SETTING['ipopt'],
+        'warm_start_init_point': 'yes',
+        'warm_start_bound_push': 1e-9,
+        'warm_start_bound_frac': 1e-9,
+        'warm_start_slack_bound_push': 1e-9,
+        'warm_start_slack_bound_frac': 1e-9,
+        'warm_start_mult_bound_push': 1e-9,
+        'mu_init': 1e-6,
+    },
+    'print_time': 0,
+}
+
 QPOASES_SETTING = {
     'terminationTolerance': 1e-16,
     'boundTolerance': 1.0e-16,
 }
 
-SYMBOL_DEBUG = True
-
-CONFIGS: dict = json2dict('config.json')
+# Regularization of singular KKT matrices in STEP 3
+KKT_REGULARIZATION = 1e-8
 
-ALADIN_CFGS = dict()
-for acn in ['max_iter', 'tol', 'copied_gap']:
-    ALADIN_CFGS[acn.upper()] = CONFIGS['aladin']['config'][acn]
-
-SAMPLE_N1: int = CONFIGS['sampling']['N1']
-SAMPLE_N2: int = CONFIGS['sampling']['N2']
-
-POOL_CNT: int = mp.cpu_count() // CONFIGS['performance']['cpu_div']
-
-V_INITS: list = csv2list('data/cars.csv')
-T_GUESS: list = csv2list('data/t_guess.csv')
-
-# UNIT CONVERSION: km/h -> m/s
-def kmph2mps(d: dict) -> dict:
-    d['V0'] /= 3.6
-    d['Vref'] /= 3.6
-    return d
-
-# Apply unit conversion
-V_INITS = [kmph2mps(d) for d in V_INITS]
-# V_INITS = list(map(kmph2mps, V_INITS))
+SYMBOL_DEBUG = True
 
-SUB_SYS_COUNT: int = len(V_INITS)
+# former global variables and the attribute of `ProblemInstance` they come from
+_INSTANCE_GLOBALS = {
+    'CONFIGS': 'configs',
+    'ALADIN_CFGS': 'aladin_cfgs',
+    'FORMULATION_CFGS': 'formulation_cfgs',
+    'INSTRUMENT_CFGS': 'instrument_cfgs',
+    'MPC_CFGS': 'mpc_cfgs',
+    'GUESS_CFGS': 'guess_cfgs',
+    'ADAPTIVE_ρ_CFGS': 'adaptive_ρ_cfgs',
+    'CODEGEN_CFGS': 'codegen_cfgs',
+    'LOG_CFGS': 'log_cfgs',
+    'SAMPLE_N1': 'sample_n1',
+    'SAMPLE_N2': 'sample_n2',
+    'POOL_CNT': 'pool_cnt',
+    'PARALLEL': 'parallel',
+    'SOLVER_CACHE': 'solver_cache',
+    'V_INITS': 'v_inits',
+    'T_GUESS': 't_guess',
+    'SUB_SYS_COUNT': 'sub_sys_count',
+    'PRINT_LEVEL': 'print_level',
+}
 
-PRINT_LEVEL: int = CONFIGS['debug']['print_level']
+def __getattr__(name):
+    if name in _INSTANCE_GLOBALS:
+        return getattr(get_instance(), _INSTANCE_GLOBALS[name])
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
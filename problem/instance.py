@@ -0,0 +1,236 @@
+"""
+================
+Problem Instance
+================
+
+All data of one intersection problem, i.e. `config.json`,
+`data/cars.csv` and `data/t_guess.csv` under `base_dir`.
+
+Nothing is read before it is accessed, velocities are
+converted to m/s exactly once, and `get_instance` keeps
+one instance per directory, so that many problems can
+live in one process.
+
+"""
+
+import os
+import uuid
+import multiprocessing as mp
+from functools import cached_property
+
+from helper.io import json2dict, csv2list
+
+ALADIN_CFG_NAMES = ['max_iter', 'tol', 'copied_gap', 'warm_start',
+                    'line_search', 'merit_penalty', 'ls_factor', 'ls_max_iter', 'ls_armijo', 'active_tol',
+                    'qp_solver', 'hessian']
+FORMULATION_CFG_NAMES = ['condensed', 'shooting']
+INSTRUMENT_CFG_NAMES = ['enabled', 'path']
+MPC_CFG_NAMES = ['cycles', 'cycle_time', 'deadline']
+GUESS_CFG_NAMES = ['method', 'coarse_N1', 'coarse_N2']
+ADAPTIVE_ρ_CFG_NAMES = ['enabled', 'min', 'max', 'ratio', 'increase', 'decrease', 'stall']
+CODEGEN_CFG_NAMES = ['enabled', 'cache_dir', 'compiler', 'flags']
+LOG_CFG_NAMES = ['path', 'level', 'buffer']
+# every entry of config.json read by an instance, by section
+REQUIRED_CFG_NAMES = {
+    ('aladin', 'config'): ALADIN_CFG_NAMES,
+    ('aladin', 'para'): ['ρ', 'H'],
+    ('aladin', 'guess'): GUESS_CFG_NAMES + ['λ'],
+    ('aladin', 'adaptive_ρ'): ADAPTIVE_ρ_CFG_NAMES,
+    ('problem', 'formulation'): FORMULATION_CFG_NAMES,
+    ('sampling',): ['N1', 'N2'],
+    ('performance',): ['cpu_div', 'parallel', 'solver_cache', 'derivative_map'],
+    ('performance', 'codegen'): CODEGEN_CFG_NAMES,
+    ('mpc',): MPC_CFG_NAMES,
+    ('debug',): ['print_level'],
+    ('debug', 'instrument'): INSTRUMENT_CFG_NAMES,
+    ('debug', 'log'): LOG_CFG_NAMES,
+}
+CARS_COLUMNS = ['P0', 'V0', 'Vref', 'Din', 'Dout', 'Umin', 'Umax']
+
+# UNIT CONVERSION: km/h -> m/s
+def kmph2mps(d: dict) -> dict:
+    d['V0'] /= 3.6
+    d['Vref'] /= 3.6
+    return d
+
+class ProblemInstance:
+    """`class` ProblemInstance
+    --------------------------
+    Read from `base_dir` (CWD by default), unless `configs`,
+    `cars` or `t_guess` are given. `cars` are rows of
+    `data/cars.csv`, velocities in km/h.
+    """
+    def __init__(self, base_dir=None, configs=None, cars=None, t_guess=None):
+        self.base_dir = os.path.abspath(base_dir or os.getcwd())
+        # identifies the instance, also in worker processes
+        self.key = uuid.uuid4().hex
+        self._configs = configs
+        self._cars = cars
+        self._t_guess = t_guess
+
+    def _path(self, *parts):
+        return os.path.join(self.base_dir, *parts)
+
+    @cached_property
+    def configs(self) -> dict:
+        return self._configs if self._configs is not None else json2dict(self._path('config.json'))
+
+    @cached_property
+    def cars(self) -> list:
+        """rows of `data/cars.csv`, velocities in km/h
+        """
+        return self._cars if self._cars is not None else csv2list(self._path('data', 'cars.csv'))
+
+    @cached_property
+    def v_inits(self) -> list:
+        # copies, rows of `cars` are not modified
+        return [kmph2mps(dict(d)) for d in self.cars]
+
+    @cached_property
+    def t_guess(self) -> list:
+        return self._t_guess if self._t_guess is not None else csv2list(self._path('data', 't_guess.csv'))
+
+    @cached_property
+    def aladin_cfgs(self) -> dict:
+        return {acn.upper(): self.configs['aladin']['config'][acn] for acn in ALADIN_CFG_NAMES}
+
+    @cached_property
+    def formulation_cfgs(self) -> dict:
+        return {fcn.upper(): self.configs['problem']['formulation'][fcn] for fcn in FORMULATION_CFG_NAMES}
+
+    @cached_property
+    def instrument_cfgs(self) -> dict:
+        instrument_cfgs = {icn.upper(): self.configs['debug']['instrument'][icn] for icn in INSTRUMENT_CFG_NAMES}
+        instrument_cfgs['PATH'] = self._path(instrument_cfgs['PATH'])
+        return instrument_cfgs
+
+    @cached_property
+    def log_cfgs(self) -> dict:
+        log_cfgs = {lcn.upper(): self.configs['debug']['log'][lcn] for lcn in LOG_CFG_NAMES}
+        if log_cfgs['PATH']:
+            log_cfgs['PATH'] = self._path(log_cfgs['PATH'])
+        return log_cfgs
+
+    @cached_property
+    def guess_cfgs(self) -> dict:
+        return {gcn.upper(): self.configs['aladin']['guess'][gcn] for gcn in GUESS_CFG_NAMES}
+
+    @cached_property
+    def adaptive_ρ_cfgs(self) -> dict:
+        return {arcn.upper(): self.configs['aladin']['adaptive_ρ'][arcn] for arcn in ADAPTIVE_ρ_CFG_NAMES}
+
+    @cached_property
+    def codegen_cfgs(self) -> dict:
+        codegen_cfgs = {ccn.upper(): self.configs['performance']['codegen'][ccn] for ccn in CODEGEN_CFG_NAMES}
+        codegen_cfgs['CACHE_DIR'] = self._path(codegen_cfgs['CACHE_DIR'])
+        return codegen_cfgs
+
+    @cached_property
+    def mpc_cfgs(self) -> dict:
+        return {mcn.upper(): self.configs['mpc'][mcn] for mcn in MPC_CFG_NAMES}
+
+    @property
+    def sample_n1(self) -> int:
+        return self.configs['sampling']['N1']
+
+    @property
+    def sample_n2(self) -> int:
+        return self.configs['sampling']['N2']
+
+    @property
+    def param_ρ(self) -> float:
+        return self.configs['aladin']['para']['ρ']
+
+    @property
+    def param_H(self) -> list:
+        return self.configs['aladin']['para']['H']
+
+    @cached_property
+    def pool_cnt(self) -> int:
+        return max(1, mp.cpu_count() // self.configs['performance']['cpu_div'])
+
+    @property
+    def parallel(self) -> bool:
+        return self.configs['performance']['parallel']
+
+    @property
+    def solver_cache(self) -> bool:
+        return self.configs['performance']['solver_cache']
+
+    @property
+    def derivative_map(self) -> str:
+        return self.configs['performance']['derivative_map']
+
+    @property
+    def print_level(self) -> int:
+        return self.configs['debug']['print_level']
+
+    @property
+    def sub_sys_count(self) -> int:
+        return len(self.v_inits)
+
+    def validate(self):
+        """raise `ValueError` describing the first problem found
+        """
+        for section, names in REQUIRED_CFG_NAMES.items():
+            entries = self.configs
+            for depth, key in enumerate(section):
+                entries = entries.get(key) if isinstance(entries, dict) else None
+                if not isinstance(entries, dict):
+                    raise ValueError('missing section {} in config.json'.format('.'.join(section[:depth+1])))
+            missing = [name for name in names if name not in entries]
+            if missing:
+                raise ValueError('missing entry {} in config.json'.format(
+                    ', '.join('.'.join(section + (name,)) for name in missing)
+                ))
+
+        sample_n1, sample_n2 = self.sample_n1, self.sample_n2
+        if not all(isinstance(n, int) and n > 0 for n in (sample_n1, sample_n2)):
+            raise ValueError('N1 and N2 must be positive integers, got {} and {}'.format(sample_n1, sample_n2))
+        if self.aladin_cfgs['LINE_SEARCH'] not in ('full', 'backtracking'):
+            raise ValueError('unknown line search {}'.format(self.aladin_cfgs['LINE_SEARCH']))
+        if self.aladin_cfgs['QP_SOLVER'] not in ('kkt', 'qpoases'):
+            raise ValueError('unknown QP solver {}'.format(self.aladin_cfgs['QP_SOLVER']))
+        if self.derivative_map not in ('none', 'serial', 'thread'):
+            raise ValueError('unknown derivative map {}'.format(self.derivative_map))
+        if self.aladin_cfgs['HESSIAN'] not in ('exact', 'bfgs'):
+            raise ValueError('unknown Hessian {}'.format(self.aladin_cfgs['HESSIAN']))
+        adaptive_ρ_cfgs = self.adaptive_ρ_cfgs
+        if not 0 < adaptive_ρ_cfgs['MIN'] <= adaptive_ρ_cfgs['MAX']:
+            raise ValueError('adaptive ρ needs 0 < min <= max')
+        if not all(adaptive_ρ_cfgs[name] > 1 for name in ('RATIO', 'INCREASE', 'DECREASE')):
+            raise ValueError('adaptive ρ needs ratio, increase and decrease above 1')
+        if not 0 < adaptive_ρ_cfgs['STALL'] <= 1:
+            raise ValueError('adaptive ρ needs 0 < stall <= 1')
+        if not (isinstance(self.configs['performance']['cpu_div'], int) and self.configs['performance']['cpu_div'] > 0):
+            raise ValueError('cpu_div must be a positive integer')
+        if self.guess_cfgs['METHOD'] not in ('constant_acceleration', 'centralized'):
+            raise ValueError('unknown guess method {}'.format(self.guess_cfgs['METHOD']))
+        if self.formulation_cfgs['SHOOTING'] not in ('single', 'multiple'):
+            raise ValueError('unknown shooting {}'.format(self.formulation_cfgs['SHOOTING']))
+
+        if self.sub_sys_count < 1:
+            raise ValueError('no vehicle in data/cars.csv')
+        for v_index, sub_known in enumerate(self.v_inits):
+            missing = [col for col in CARS_COLUMNS if sub_known.get(col) is None]
+            if missing:
+                raise ValueError('vehicle {} misses {}'.format(v_index+1, ', '.join(missing)))
+            if sub_known['Umin'] >= sub_known['Umax']:
+                raise ValueError('vehicle {} has Umin >= Umax'.format(v_index+1))
+        if len(self.t_guess) != self.sub_sys_count:
+            raise ValueError('{} vehicles but {} time guesses'.format(self.sub_sys_count, len(self.t_guess)))
+
+        return self
+
+_instances = dict()
+
+def get_instance(base_dir=None) -> ProblemInstance:
+    """`function` get_instance
+    --------------------------
+    The instance of `base_dir` (CWD by default),
+    created on first call.
+    """
+    base_dir = os.path.abspath(base_dir or os.getcwd())
+    if base_dir not in _instances:
+        _instances[base_dir] = ProblemInstance(base_dir)
+    return _instances[base_dir]
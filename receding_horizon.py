@@ -0,0 +1,189 @@
+"""
+Receding-horizon (MPC) mode
+===========================
+
+Every control cycle
+
+    1. re-solves ALADIN from the shifted plan of the previous cycle,
+       stopping at the deadline with the last coupling-feasible
+       iterate found so far,
+    2. applies the first `cycle_time` seconds of every plan,
+    3. freezes the schedule of vehicles which have entered the
+       intersection, and drops vehicles which have exited (Dout passed).
+
+A vehicle inside the intersection can't change its schedule any
+more, so it leaves the problem and follows the plan it entered
+with until it exits, its remaining time to exit is a lower bound
+on Tin of the vehicle behind it. If a solve returns no feasible
+plan, the shifted plan of the previous cycle is applied instead.
+
+Settings are in the `mpc` section of `config.json`.
+"""
+import time
+
+import numpy as np
+
+import intersection
+from problem import ProblemInstance, get_instance
+from helper import constructor
+from helper.colorize import color_print, configure_log
+from helper.coupling import resize_τ
+from helper.centralized_reference import get_initial_guess
+from helper.subsystype import get_sub_system_type
+from aladin.step_4_solve_qp import ConsensusQP
+
+def advance_vehicle(sub_known, τ, u, sample_n1, sample_n2, duration):
+    """position and velocity (m/s) after following the plan for `duration`
+    """
+    position, velocity = sub_known['P0'], sub_known['V0']
+    for u_index, control in enumerate(u):
+        len_t_s = τ[0]/sample_n1 if u_index < sample_n1 else (τ[1]-τ[0])/sample_n2
+        len_t_s = min(len_t_s, duration)
+        position += len_t_s*velocity + len_t_s**2/2*control
+        velocity += len_t_s*control
+        duration -= len_t_s
+        if duration <= 0:
+            break
+    else:
+        # beyond the horizon, keep velocity
+        position += duration*velocity
+    return position, velocity
+
+def get_elapsed_samples(τ, sample_n1, sample_n2, duration) -> int:
+    """number of control samples of a plan which are over after `duration`
+    """
+    len_t_s = np.concatenate((
+        np.full(sample_n1, τ[0]/sample_n1), np.full(sample_n2, (τ[1]-τ[0])/sample_n2)
+    ))
+    return int(np.count_nonzero(np.cumsum(len_t_s) <= duration+1e-9))
+
+def shift_controls(u, sample_count):
+    """controls of a plan `sample_count` samples later,
+    the tail is padded by repeating the last control
+    """
+    u = np.asarray(u, dtype=float)
+    u_next = u[sample_count:]
+    return np.concatenate((u_next, np.full(len(u)-len(u_next), u[-1])))
+
+def has_exited(vehicle, sample_n1, sample_n2) -> bool:
+    """whether a vehicle following its plan has passed Dout
+    """
+    if vehicle['elapsed'] >= vehicle['τ'][1]:
+        return True
+    position, _ = advance_vehicle(
+        vehicle['v_init'], vehicle['τ'], vehicle['u'], sample_n1, sample_n2, vehicle['elapsed']
+    )
+    return position >= vehicle['Dout']
+
+def main(instance=None):
+    """
+    Returns one record per control cycle.
+    """
+    base_instance = get_instance() if instance is None else instance
+    base_instance.validate()
+    configure_log(base_instance)
+
+    cars = [dict(car) for car in base_instance.cars]
+    var_τ, var_u, var_λ = get_initial_guess(base_instance)
+
+    with intersection.worker_pool(base_instance) as pool:
+        return run_cycles(base_instance, cars, var_τ, var_u, var_λ, pool)
+
+def run_cycles(base_instance, cars, var_τ, var_u, var_λ, pool=None):
+    """control cycles of `main`, all solved on the same worker pool
+    """
+    mpc_cfgs = base_instance.mpc_cfgs
+    cycle_time = mpc_cfgs['CYCLE_TIME']
+    sample_n1, sample_n2 = base_instance.sample_n1, base_instance.sample_n2
+    # vehicles inside the intersection, with the plan they entered with
+    crossing = []
+
+    consensus_qp = ConsensusQP()
+    records = []
+
+    for cycle in range(mpc_cfgs['CYCLES']):
+        if not cars and not crossing:
+            break
+        time_cycle = time.perf_counter()
+        record = {'cycle': cycle, 'vehicles': [car['carid'] for car in cars],
+                  'crossing': [vehicle['carid'] for vehicle in crossing]}
+        # plans of the vehicles entering in this cycle
+        entered = []
+
+        if cars:
+            # exit time of the vehicles inside the intersection
+            t_in_min = max([vehicle['τ'][1]-vehicle['elapsed'] for vehicle in crossing], default=0.)
+
+            sub_sys_count = len(cars)
+            instance = ProblemInstance(
+                base_instance.base_dir, configs=base_instance.configs, cars=cars,
+                t_guess=[{'carid': car['carid'], 'TinG': τ[0], 'ToutG': τ[1]} for car, τ in zip(cars, var_τ)]
+            )
+
+            # P0 and V0 are NLP parameters, structs share the templates of their type
+            nlp_struct = [constructor.build_nlp_struct(sub_index, instance=instance) for sub_index in range(sub_sys_count)]
+            nlp_struct[0]['lbx'] = [max(0., t_in_min)] + nlp_struct[0]['lbx'][1:]
+            var_τ = [
+                resize_τ(τ, get_sub_system_type(sub_sys_count, sub_index))
+                for sub_index, τ in enumerate(var_τ)
+            ]
+
+            summary = intersection.solve(
+                instance, nlp_struct, var_τ, var_u, var_λ, consensus_qp,
+                time_budget=mpc_cfgs['DEADLINE']-(time.perf_counter()-time_cycle), pool=pool
+            )
+            record.update({
+                'time': time.perf_counter()-time_cycle,
+                'deadline_hit': summary['deadline_hit'],
+                'converged': summary['converged'],
+                'feasible': summary['feasible'],
+                'iter_count': summary['iter_count'],
+                'residual': summary['residual'],
+            })
+            color_print('info', 0, 'cycle {cycle} vehicles {vehicles} {time:.3f} s, iter {iter_count}, residual {residual:.2e}', **record)
+
+            if summary['feasible']:
+                var_τ = [np.array(τ) for τ in summary['τ']]
+                var_u = [np.array(u) for u in summary['u']]
+                var_λ = np.array(summary['λ'])
+            else:
+                color_print('warning', 0, 'cycle {} has no feasible plan, the previous one is applied', cycle)
+
+            # apply the plan, time is counted from the next cycle on
+            plans = [
+                {'carid': car['carid'], 'Dout': car['Dout'], 'v_init': sub_known, 'τ': τ, 'u': u, 'elapsed': 0.}
+                for car, sub_known, τ, u in zip(cars, instance.v_inits, var_τ, var_u)
+            ]
+            for sub_index, plan in enumerate(plans):
+                position, velocity = advance_vehicle(
+                    plan['v_init'], plan['τ'], plan['u'], sample_n1, sample_n2, cycle_time
+                )
+                cars[sub_index] = {**cars[sub_index], 'P0': position, 'V0': velocity*3.6}
+            var_u = [
+                shift_controls(u, get_elapsed_samples(τ, sample_n1, sample_n2, cycle_time))
+                for τ, u in zip(var_τ, var_u)
+            ]
+            var_τ = [τ - cycle_time for τ in var_τ]
+
+            while cars and (cars[0]['P0'] >= cars[0]['Din'] or var_τ[0][0] <= 0):
+                color_print('ok', 0, 'vehicle {} has entered the intersection', cars[0]['carid'])
+                entered.append(plans[0])
+                cars, plans, var_τ, var_u, var_λ = cars[1:], plans[1:], var_τ[1:], var_u[1:], var_λ[1:]
+        else:
+            record['time'] = time.perf_counter()-time_cycle
+        records.append(record)
+
+        # vehicles inside the intersection follow the plan they entered with
+        still_crossing = []
+        for vehicle in crossing + entered:
+            vehicle['elapsed'] += cycle_time
+            if has_exited(vehicle, sample_n1, sample_n2):
+                color_print('ok', 0, 'vehicle {} has exited the intersection', vehicle['carid'])
+            else:
+                still_crossing.append(vehicle)
+        crossing = still_crossing
+
+    return records
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+"""
+==============
+Service Module
+==============
+
+A resident solver re-planning the intersection whenever
+vehicles arrive or depart, and a stand-in client.
+
+    python -m service.server --port 8765
+    python -m service.client
+
+"""
@@ -0,0 +1,84 @@
+"""
+================
+Stand-in Client
+================
+
+Replays `data/cars.csv` against the solver service: vehicles
+arrive one by one, the first one departs, then statistics are
+requested. Starts its own service over stdin / stdout unless
+`--port` of a running service is given.
+
+    python -m service.client
+    python -m service.client --port 8765
+
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from helper.io import csv2list
+
+async def open_service(port, host):
+    if port is not None:
+        reader, writer = await asyncio.open_connection(host, port)
+        return reader, writer, None
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'service.server', '--stdio',
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    return process.stdout, process.stdin, process
+
+def get_requests(cars, t_guess):
+    requests = [
+        {'op': 'arrive', 'car': {**car, 'TinG': guess['TinG'], 'ToutG': guess['ToutG']}}
+        for car, guess in zip(cars, t_guess)
+    ]
+    requests += [{'op': 'depart', 'carid': cars[0]['carid']}, {'op': 'stats'}, {'op': 'shutdown'}]
+    for request_id, request in enumerate(requests):
+        request['id'] = request_id
+    return requests
+
+async def replay(requests, port=None, host='127.0.0.1'):
+    reader, writer, process = await open_service(port, host)
+    responses = []
+    for request in requests:
+        writer.write((json.dumps(request) + '\n').encode('utf-8'))
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        responses.append(response)
+
+        if request['op'] == 'stats':
+            print(json.dumps(response['stats'], indent=2))
+        elif not response['ok']:
+            print('{:>3} {:<8} error: {}'.format(response['id'], request['op'], response['error']))
+        else:
+            solve = response.get('solve') or dict()
+            print('{:>3} {:<8} {:>8.3f} s  queue {}  iter {}  converged {}'.format(
+                response['id'], request['op'], response['latency'], response['queue_depth'],
+                solve.get('iter_count', '-'), solve.get('converged', '-')
+            ))
+
+    writer.close()
+    if process is not None:
+        await process.wait()
+    return responses
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='stand-in client of the solver service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='running service, otherwise one is started')
+    parser.add_argument('--data-dir', default='data')
+    args = parser.parse_args(argv)
+
+    requests = get_requests(
+        csv2list(os.path.join(args.data_dir, 'cars.csv')),
+        csv2list(os.path.join(args.data_dir, 't_guess.csv'))
+    )
+    asyncio.run(replay(requests, args.port, args.host))
+
+if __name__ == '__main__':
+    main()
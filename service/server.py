@@ -0,0 +1,352 @@
+"""
+==============
+Solver Service
+==============
+
+A resident process which re-solves the intersection problem
+whenever vehicles arrive or depart. NLP structs are kept per
+vehicle and subsystem type, consensus QP solvers are kept by
+sparsity, and every re-solve starts from the previous τ, u, λ.
+
+Requests and responses are JSON lines, over a local TCP socket
+or stdin / stdout. Responses carry the `id` of the request,
+its latency and the queue depth when it was received.
+
+    {"id": 1, "op": "arrive", "car": {"carid": 5, "P0": -170, "V0": 80, "Vref": 80,
+                                      "Din": 0, "Dout": 10, "Umin": -2, "Umax": 2}}
+    {"id": 2, "op": "depart", "carid": 1}
+    {"id": 3, "op": "solve"}
+    {"id": 4, "op": "stats"}
+    {"id": 5, "op": "shutdown"}
+
+Vehicles cross in order of arrival. `TinG` and `ToutG` may be
+given with the car, otherwise they are estimated. Events waiting
+in the queue are applied together and solved once.
+
+    python -m service.server --port 8765
+    python -m service.server --stdio
+
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import numbers
+import sys
+import time
+
+import numpy as np
+
+import intersection
+from problem import ProblemInstance, SYMBOL_DEBUG, get_instance
+from problem.instance import CARS_COLUMNS
+from helper import constructor
+from helper.colorize import configure_log
+from helper.coupling import resize_τ
+from helper.subsystype import get_sub_system_type
+from aladin.step_4_solve_qp import ConsensusQP
+
+def is_finite_number(val) -> bool:
+    return isinstance(val, numbers.Real) and not isinstance(val, bool) and math.isfinite(val)
+
+def format_error(err) -> str:
+    return '{}: {}'.format(type(err).__name__, err)
+
+class IntersectionState:
+    """`class` IntersectionState
+    ----------------------------
+    Vehicles currently approaching, in crossing order, with their
+    latest iterates and NLP structs. Not thread-safe, the service
+    only touches it from one solving thread at a time. STEP 1 runs
+    on `pool` if given, which is kept for the lifetime of the service.
+    """
+    def __init__(self, base_instance, pool=None):
+        self.base_instance = base_instance
+        self.pool = pool
+        self.cars = []
+        self.t_guess = dict()
+        self.var_τ = dict()
+        self.var_u = dict()
+        # λ of the coupling of two consecutive vehicles
+        self.var_λ = dict()
+        self.nlp_struct = dict()
+        self.consensus_qp = ConsensusQP()
+        self.build_count = 0
+        self.solve_count = 0
+        self.last_summary = None
+
+    @property
+    def carids(self) -> list:
+        return [car['carid'] for car in self.cars]
+
+    def arrive(self, car: dict):
+        carid = car.get('carid')
+        if carid is None or carid in self.carids:
+            raise ValueError('car needs a new `carid`, got {}'.format(carid))
+        missing = [col for col in CARS_COLUMNS if col not in car]
+        if missing:
+            raise ValueError('car {} misses {}'.format(carid, ', '.join(missing)))
+        numeric_cols = CARS_COLUMNS + [col for col in ('TinG', 'ToutG') if col in car]
+        invalid = [col for col in numeric_cols if not is_finite_number(car[col])]
+        if invalid:
+            raise ValueError('car {} has non-numeric {}'.format(carid, ', '.join(invalid)))
+        if car['V0'] <= 0:
+            raise ValueError('car {} needs V0 > 0, got {}'.format(carid, car['V0']))
+        if car['Umin'] >= car['Umax']:
+            raise ValueError('car {} has Umin >= Umax'.format(carid))
+
+        if 'TinG' in car and 'ToutG' in car:
+            t_in, t_out = car['TinG'], car['ToutG']
+        else:
+            # constant velocity, entering after the previous vehicle has left
+            velocity = car['V0'] / 3.6
+            t_out_prev = self.var_τ[self.cars[-1]['carid']][1] if self.cars else 0.
+            t_in = max((car['Din']-car['P0'])/velocity, t_out_prev+.01)
+            t_out = t_in + (car['Dout']-car['Din'])/velocity
+
+        if self.cars:
+            self.var_λ[(self.cars[-1]['carid'], carid)] = 1. if SYMBOL_DEBUG else -1.
+        self.cars.append({'carid': carid, **{col: car[col] for col in CARS_COLUMNS}})
+        self.t_guess[carid] = {'carid': carid, 'TinG': t_in, 'ToutG': t_out}
+        self.var_τ[carid] = np.array([t_in, t_out], dtype=float)
+        self.var_u[carid] = np.zeros(self.base_instance.sample_n1+self.base_instance.sample_n2)
+
+    def depart(self, carid):
+        if carid not in self.carids:
+            raise ValueError('unknown carid {}'.format(carid))
+        v_index = self.carids.index(carid)
+        prev_id = self.carids[v_index-1] if v_index > 0 else None
+        next_id = self.carids[v_index+1] if v_index+1 < len(self.cars) else None
+
+        # the couplings around the vehicle merge into one
+        λ_prev = self.var_λ.pop((prev_id, carid), None)
+        λ_next = self.var_λ.pop((carid, next_id), None)
+        if prev_id is not None and next_id is not None:
+            self.var_λ[(prev_id, next_id)] = λ_prev
+
+        del self.cars[v_index]
+        for store in (self.t_guess, self.var_τ, self.var_u):
+            del store[carid]
+        self.nlp_struct = {key: val for key, val in self.nlp_struct.items() if key[0] != carid}
+
+    def get_nlp_struct(self, instance, v_index):
+        """cached NLP struct of a vehicle at its current position
+        """
+        sub_sys_type = get_sub_system_type(instance.sub_sys_count, v_index)
+        struct_key = (self.cars[v_index]['carid'], sub_sys_type)
+        if struct_key not in self.nlp_struct:
+            self.nlp_struct[struct_key] = constructor.build_nlp_struct(v_index, instance=instance)
+            self.build_count += 1
+        nlp_struct = self.nlp_struct[struct_key]
+        # vehicles ahead may have departed
+        nlp_struct['λ_index'] = constructor.get_λ_index(v_index, sub_sys_type)
+        return nlp_struct
+
+    def solve(self) -> dict:
+        if not self.cars:
+            self.last_summary = {'converged': True, 'iter_count': 0, 'τ': dict()}
+            return self.last_summary
+
+        instance = ProblemInstance(
+            self.base_instance.base_dir, configs=self.base_instance.configs,
+            cars=self.cars, t_guess=[self.t_guess[carid] for carid in self.carids]
+        )
+        instance.validate()
+        carids, sub_sys_count = self.carids, len(self.cars)
+
+        nlp_struct = [self.get_nlp_struct(instance, v_index) for v_index in range(sub_sys_count)]
+
+        # Tc appears or disappears when a vehicle becomes head / body / tail
+        var_τ = [
+            resize_τ(self.var_τ[carid], get_sub_system_type(sub_sys_count, v_index))
+            for v_index, carid in enumerate(carids)
+        ]
+        var_u = [self.var_u[carid] for carid in carids]
+        var_λ = np.array([self.var_λ[pair] for pair in zip(carids[:-1], carids[1:])])
+
+        summary = intersection.solve(instance, nlp_struct, var_τ, var_u, var_λ, self.consensus_qp, pool=self.pool)
+        self.solve_count += 1
+
+        for carid, τ, u in zip(carids, summary['τ'], summary['u']):
+            self.var_τ[carid], self.var_u[carid] = np.array(τ), np.array(u)
+        for pair, λ in zip(zip(carids[:-1], carids[1:]), summary['λ']):
+            self.var_λ[pair] = λ
+
+        self.last_summary = {
+            'converged': summary['converged'],
+            'iter_count': summary['iter_count'],
+            'residual': summary['residual'],
+            'ipopt_iter': summary['ipopt_iter'],
+            'τ': {str(carid): τ for carid, τ in zip(carids, summary['τ'])},
+        }
+        return self.last_summary
+
+
+class SolverService:
+    """`class` SolverService
+    ------------------------
+    Requests are queued and handled by a single worker, solving
+    happens in a thread so that requests keep being accepted.
+    """
+    def __init__(self, base_instance, pool=None):
+        self.state = IntersectionState(base_instance, pool)
+        self.queue = asyncio.Queue()
+        self.closed = asyncio.Event()
+        self.latency = []
+        self.max_queue_depth = 0
+
+    def stats(self) -> dict:
+        latency = np.array(self.latency) if self.latency else np.zeros(1)
+        return {
+            'requests': len(self.latency),
+            'vehicles': self.state.carids,
+            'solves': self.state.solve_count,
+            'nlp_structs_built': self.state.build_count,
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'latency_mean': float(np.mean(latency)),
+            'latency_p50': float(np.percentile(latency, 50)),
+            'latency_p95': float(np.percentile(latency, 95)),
+            'latency_max': float(np.max(latency)),
+            'qp': self.state.consensus_qp.stats(),
+        }
+
+    async def submit(self, request: dict) -> dict:
+        """queue a request and wait for its response
+        """
+        time_received = time.perf_counter()
+        queue_depth = self.queue.qsize()
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'request must be a JSON object', 'queue_depth': queue_depth}
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth+1)
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        response = await future
+
+        latency = time.perf_counter() - time_received
+        self.latency.append(latency)
+        return {'id': request.get('id'), **response, 'latency': latency, 'queue_depth': queue_depth}
+
+    def apply(self, request: dict) -> bool:
+        """apply an event, return whether it needs a re-solve
+        """
+        op = request.get('op')
+        if op == 'arrive':
+            self.state.arrive(request['car'])
+        elif op == 'depart':
+            self.state.depart(request['carid'])
+        elif op not in ('solve', 'stats', 'shutdown'):
+            raise ValueError('unknown op {}'.format(op))
+        return op in ('arrive', 'depart', 'solve')
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while not self.closed.is_set():
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            responses, should_solve = [], False
+            for request, future in batch:
+                # any failure is answered, the worker must keep running
+                try:
+                    should_solve |= self.apply(request)
+                    responses.append({'ok': True, 'op': request['op']})
+                except Exception as err:
+                    responses.append({'ok': False, 'op': request.get('op'), 'error': format_error(err)})
+
+            summary, solve_error = None, None
+            if should_solve:
+                try:
+                    summary = await loop.run_in_executor(None, self.state.solve)
+                except Exception as err:
+                    solve_error = format_error(err)
+
+            for (request, future), response in zip(batch, responses):
+                if response['ok'] and request['op'] in ('arrive', 'depart', 'solve'):
+                    if solve_error is None:
+                        response['solve'] = summary
+                    else:
+                        response.update({'ok': False, 'error': 'solve failed: {}'.format(solve_error)})
+                elif response['ok'] and request['op'] == 'stats':
+                    response['stats'] = self.stats()
+                elif response['ok'] and request['op'] == 'shutdown':
+                    self.closed.set()
+                # the client may have gone away
+                if not future.done():
+                    future.set_result(response)
+
+    async def respond(self, line: bytes, write):
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as err:
+            response = {'ok': False, 'error': 'invalid JSON: {}'.format(err)}
+        else:
+            response = await self.submit(request)
+        write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    async def handle_connection(self, reader, writer):
+        tasks = []
+        try:
+            while not self.closed.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    tasks.append(asyncio.create_task(self.respond(line, writer.write)))
+            await asyncio.gather(*tasks)
+        except (asyncio.CancelledError, ConnectionError):
+            # service shut down or client went away
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(service, host=None, port=None):
+    worker = asyncio.create_task(service.worker())
+    if port is None:
+        await serve_stdio(service)
+    else:
+        server = await asyncio.start_server(service.handle_connection, host, port)
+        async with server:
+            await service.closed.wait()
+    worker.cancel()
+
+async def serve_stdio(service):
+    """requests from stdin, responses to stdout,
+    all other output is moved to stderr
+    """
+    loop = asyncio.get_running_loop()
+    protocol_out, sys.stdout = sys.stdout.buffer, sys.stderr
+
+    def write(data):
+        protocol_out.write(data)
+        protocol_out.flush()
+
+    tasks = []
+    while not service.closed.is_set():
+        line = await loop.run_in_executor(None, sys.stdin.buffer.readline)
+        if not line:
+            break
+        if line.strip():
+            tasks.append(asyncio.create_task(service.respond(line, write)))
+    await asyncio.gather(*tasks)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ALADIN intersection solver service')
+    parser.add_argument('--stdio', action='store_true', help='JSON lines over stdin / stdout')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--base-dir', help='directory of config.json, CWD by default')
+    args = parser.parse_args(argv)
+
+    base_instance = get_instance(args.base_dir)
+    configure_log(base_instance)
+
+    with intersection.worker_pool(base_instance) as pool:
+        asyncio.run(serve(SolverService(base_instance, pool), args.host, None if args.stdio else args.port))
+
+if __name__ == '__main__':
+    main()
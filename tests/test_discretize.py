@@ -0,0 +1,17 @@
+import numpy as np
+import casadi as ca
+
+from helper.discretize import get_discretized_dynamics, get_condensed_dynamics
+
+def test_condensed_dynamics_match_rollout():
+    len_t_s, position, velocity = 0.4, -160., 20.
+    control = np.random.default_rng(0).uniform(-2, 2, 12)
+
+    position_k, velocity_k = get_condensed_dynamics(len_t_s, position, velocity, ca.DM(control))
+
+    dmat_a, dmat_b = (ca.evalf(mat).full() for mat in get_discretized_dynamics(len_t_s))
+    state = np.array([position, velocity])
+    for k, control_k in enumerate(control):
+        state = dmat_a @ state + dmat_b[:, 0]*control_k
+        assert abs(float(position_k[k]) - state[0]) < 1e-9
+        assert abs(float(velocity_k[k]) - state[1]) < 1e-9
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import intersection
+from problem import ProblemInstance
+
+# τ of the 4 vehicles of `data/cars.csv`
+BASELINE_τ = [
+    [6.9011, 7.3348, 7.3348],
+    [7.3348, 7.7775, 7.7775],
+    [7.7775, 8.2287, 8.2287],
+    [8.2287, 8.6945],
+]
+
+@pytest.mark.parametrize('section, name, val', [
+    (('aladin', 'config'), 'qp_solver', 'kkt'),
+    (('aladin', 'config'), 'qp_solver', 'qpoases'),
+    (('aladin', 'config'), 'hessian', 'bfgs'),
+    (('problem', 'formulation'), 'shooting', 'multiple'),
+    (('problem', 'formulation'), 'condensed', True),
+])
+def test_converges_to_baseline(problem_dir, section, name, val):
+    configs = problem_dir.configs
+    for key in section:
+        configs = configs[key]
+    configs[name] = val
+
+    summary = intersection.main(ProblemInstance(problem_dir.write()))
+
+    assert summary['converged'] and summary['feasible']
+    for τ, baseline_τ in zip(summary['τ'], BASELINE_τ):
+        np.testing.assert_allclose(τ, baseline_τ, atol=1e-3)
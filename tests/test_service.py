@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from problem import ProblemInstance
+from service.server import SolverService
+
+CAR = {'carid': 5, 'P0': -170, 'V0': 80, 'Vref': 80, 'Din': 0, 'Dout': 10, 'Umin': -2, 'Umax': 2}
+
+def run_requests(problem_dir, requests):
+    async def run():
+        service = SolverService(ProblemInstance(problem_dir.write()))
+        worker = asyncio.create_task(service.worker())
+        responses = [await service.submit(request) for request in requests]
+        worker.cancel()
+        return service, responses
+    return asyncio.run(run())
+
+@pytest.mark.parametrize('request_, error', [
+    ([1, 2], 'JSON object'),
+    ({'op': 'fly'}, 'unknown op'),
+    ({'op': 'arrive', 'car': {**CAR, 'V0': 0}}, 'V0 > 0'),
+    ({'op': 'arrive', 'car': {**CAR, 'P0': 'far'}}, 'non-numeric P0'),
+    ({'op': 'arrive', 'car': {**CAR, 'Umin': 2, 'Umax': -2}}, 'Umin >= Umax'),
+    ({'op': 'arrive', 'car': {key: val for key, val in CAR.items() if key != 'Din'}}, 'misses Din'),
+    ({'op': 'depart', 'carid': 7}, 'unknown carid'),
+])
+def test_rejects_malformed_request(problem_dir, request_, error):
+    service, (response, stats) = run_requests(problem_dir, [request_, {'op': 'stats'}])
+
+    assert not response['ok']
+    assert error in response['error']
+    # the service keeps answering, and nothing was added
+    assert stats['ok'] and stats['stats']['vehicles'] == []
+
+def test_respond_rejects_invalid_json(problem_dir):
+    service = SolverService(ProblemInstance(problem_dir.write()))
+    written = []
+    asyncio.run(service.respond(b'{"op": ', written.append))
+    assert b'invalid JSON' in written[0]
@@ -0,0 +1,21 @@
+import numpy as np
+
+from aladin.step_4_solve_qp import step_4_solve_qp, ConsensusQP
+from helper.coupling import get_τ_offsets, build_coupling_matrix
+
+def test_kkt_agrees_with_qpoases():
+    rng = np.random.default_rng(0)
+    τ_offsets = get_τ_offsets(5)
+    τ_sizes = np.diff(τ_offsets)
+    qp_h = [rng.normal(size=(n, n)) for n in τ_sizes]
+    qp_h = [H_i @ H_i.T + np.eye(len(H_i)) for H_i in qp_h]
+    qp_g = [rng.normal(size=(n, 1)) for n in τ_sizes]
+    qp_a = build_coupling_matrix(τ_offsets, np.array([True, False, True, True]))
+    qp_b = rng.normal(size=qp_a.shape[0])
+
+    kkt_Δτ, kkt_λ = step_4_solve_qp(qp_h, qp_g, qp_a, qp_b, ConsensusQP(), 'kkt')
+    qpoases_Δτ, qpoases_λ = step_4_solve_qp(qp_h, qp_g, qp_a, qp_b, ConsensusQP(), 'qpoases')
+
+    np.testing.assert_allclose(qp_a @ kkt_Δτ[:, 0], qp_b, atol=1e-9)
+    np.testing.assert_allclose(kkt_Δτ, qpoases_Δτ, atol=1e-6)
+    np.testing.assert_allclose(kkt_λ, qpoases_λ, atol=1e-6)